@@ -15,6 +15,21 @@ CORS_HEADERS = ["*"]
 # Database Configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
+# BOM Configuration
+# When disabled, tree builds fetch each BOM with a single recursive query
+# instead of serving edges from the in-memory relationship index.
+BOM_INDEX_ENABLED = os.getenv("BOM_INDEX_ENABLED", "true").lower() == "true"
+# Daily background job storing each component's rolled-up cost
+COST_SNAPSHOTS_ENABLED = os.getenv("COST_SNAPSHOTS_ENABLED", "true").lower() == "true"
+
+# Stock Configuration
+# Relative stock changes arriving within this window are written together; 0 (default) disables.
+# Only worth enabling when many scanners book the same parts at the same time.
+STOCK_COALESCE_WINDOW_MS = float(os.getenv("STOCK_COALESCE_WINDOW_MS", "0"))
+# Answers to requests sent with an Idempotency-Key header are kept this long
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+
 # App Configuration
 APP_TITLE = "Components Inventory API"
 APP_VERSION = "1.0.0"
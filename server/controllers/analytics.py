@@ -1,4 +1,7 @@
+from datetime import date, datetime, time
+from typing import List, Optional
 from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from prisma import Prisma
 from prisma.enums import TypeOfComponent
 from prisma.errors import RecordNotFoundError
@@ -6,69 +9,38 @@ from prisma.errors import RecordNotFoundError
 from .auth.auth import get_current_user
 from .auth.models import User
 from .database import get_db
-from models import Component, ComponentCreate, ComponentUpdate, ComponentTree, TreeNode, GraphData, Node, NodeData, Edge
+from models import Component, ComponentCreate, ComponentUpdate, ComponentTree, TreeNode, GraphData, Node, NodeData, Edge, ExplodeRequest, WhatIfRequest
 
-from controllers.tree import get_tree
+from controllers.tree import iter_tree_nodes, ndjson_stream
+from controllers.rollup import Rollup, compute_rollups, explode_plan, missing_components
+from controllers.bom_index import get_bom_index
+from controllers.bom_matrix import load_bom_matrix
+from controllers.cost_snapshots import get_cost_history, take_cost_snapshot
+from controllers.buildable import get_buildable
 
 
 router = APIRouter(prefix="/analytics", tags=["analytics"])
 
 
-async def _get_component_cost(component_name: str, db: Prisma) -> float:
-    try:
-        component = await db.components.find_first(
-            where={"componentName": component_name}
-        )
-        if not component:
-            raise RecordNotFoundError(f"Component '{component_name}' not found")
-        return component.cost
-    except RecordNotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
-
-
-async def _get_component_labor_cost(component_name: str, db: Prisma) -> float:
-    """Compute labor cost using each stage's assigned labor profile rate."""
-    try:
-        component = await db.components.find_first(
-            where={"componentName": component_name},
-            include={"productionStages": {"include": {"laborProfile": True}}}
-        )
-        if not component:
-            raise RecordNotFoundError(f"Component '{component_name}' not found")
-
-        total_labor = 0.0
-        for stage in (component.productionStages or []):
-            if stage.laborProfile:
-                total_labor += stage.duration * stage.laborProfile.hourlyRate
-        return total_labor
-    except RecordNotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
-
-
-async def _get_component_duration(component_name: str, db: Prisma) -> float:
-    try:
-        component = await db.components.find_first(
-            where={"componentName": component_name},
-            include={"productionStages": {"order_by": {"order": "asc"}}}
-        )
-        if not component:
-            raise RecordNotFoundError(f"Component '{component_name}' not found")
-        total_duration = sum(stage.duration for stage in (component.productionStages or []))
-        return total_duration
-    except RecordNotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
+async def _get_rollup(topName: str, db: Prisma) -> Rollup:
+    """Rolled-up figures for topName; 404 if it or any component in its BOM is missing."""
+    rollups = await compute_rollups([topName], db)
+    missing = missing_components(rollups)
+    if missing:
+        raise RecordNotFoundError(f"Component '{missing[0]}' not found")
+    return rollups[topName]
 
 
-async def _get_component_delivery_duration(component_name: str, db: Prisma) -> float:
-    try:
-        component = await db.components.find_first(
-            where={"componentName": component_name}
-        )
-        if not component:
-            raise RecordNotFoundError(f"Component '{component_name}' not found")
-        return component.delivery_time or 0.0
-    except RecordNotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
+def _critical_path(rollup: Rollup) -> list:
+    return [
+        {
+            "component_name": step.name,
+            "duration": step.own_duration,
+            "delivery_time": step.delivery_time,
+            "lead_time": step.lead_time,
+        }
+        for step in rollup.critical_path()
+    ]
 
 
 @router.get("/total-cost", response_model=dict)
@@ -79,20 +51,8 @@ async def get_component_total_cost(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        tree = await get_tree(topName=topName, db=db, current_user=current_user)
-
-        async def dfs_post_order_cost(node):
-            children_cost = 0.
-            for child in node["children"]:
-                child_cost = await dfs_post_order_cost(child)
-                children_cost += child_cost * child["amount"]
-
-            material_cost = await _get_component_cost(node["name"], db)
-            labor_cost = await _get_component_labor_cost(node["name"], db)
-            return children_cost + material_cost + labor_cost
-
-        total_calculated_cost = await dfs_post_order_cost(tree["tree"])
-        return {"total_cost": total_calculated_cost * amount}
+        rollup = await _get_rollup(topName, db)
+        return {"total_cost": rollup.total * amount}
 
     except RecordNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -108,30 +68,12 @@ async def get_component_total_duration(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        tree = await get_tree(topName=topName, db=db, current_user=current_user)
-
-        async def dfs_post_order_duration(node):
-            if not node["children"]:
-                delivery_duration = await _get_component_delivery_duration(node["name"], db)
-                return 0.0, delivery_duration
-
-            children_manufacturing_duration = 0.0
-            max_delivery_duration = 0.0
-
-            for child in node["children"]:
-                child_manufacturing, child_delivery = await dfs_post_order_duration(child)
-                children_manufacturing_duration += child_manufacturing * child["amount"]
-                max_delivery_duration = max(max_delivery_duration, child_delivery)
-
-            own_manufacturing_duration = await _get_component_duration(node["name"], db)
-            total_manufacturing = children_manufacturing_duration + own_manufacturing_duration
-
-            return total_manufacturing, max_delivery_duration
-
-        total_manufacturing_duration, max_delivery_duration = await dfs_post_order_duration(tree["tree"])
+        rollup = await _get_rollup(topName, db)
         return {
-            "total_manufacturing_duration": total_manufacturing_duration * amount,
-            "max_delivery_duration": max_delivery_duration,
+            "total_manufacturing_duration": rollup.manufacturing * amount,
+            "max_delivery_duration": rollup.max_delivery,
+            "lead_time": rollup.lead_time,
+            "critical_path": _critical_path(rollup),
         }
     except RecordNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -139,45 +81,54 @@ async def get_component_total_duration(
         raise HTTPException(status_code=400, detail=f"Could not retrieve component tree: {str(e)}")
 
 
-@router.get("/bom-export", response_model=list)
-async def get_bom_export(
-    topName: str = Query(..., description="Top-level component name"),
+@router.get("/lead-times", response_model=dict)
+async def get_lead_times(
+    topNames: List[str] = Query(..., description="Top-level component names"),
     db: Prisma = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Return a flat BOM list for the given top component with per-stage labor costs."""
-    async def dfs(node, depth: int, accumulated_amount: float = 1.0):
-        """Post-order DFS. Returns (ordered_rows, subtree_material_per_unit, subtree_labor_per_unit).
-
-        subtree_material_per_unit and subtree_labor_per_unit are the full recursive
-        BOM costs for one unit of this node — the same breakdown that the inventory
-        component shows via get_component_total_cost_detailed.
-        """
-        name = node["name"]
-        amount = node["amount"]
+    """Critical-path lead time for many top items; shared sub-assemblies are computed once."""
+    try:
+        rollups = await compute_rollups(topNames, db)
+        missing = missing_components({name: rollups[name] for name in topNames})
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Component '{missing[0]}' not found")
 
-        comp = await db.components.find_first(
-            where={"componentName": name},
-            include={
-                "productionStages": {"include": {"laborProfile": True}},
-                "manuals": True
+        return {
+            name: {
+                "lead_time": rollups[name].lead_time,
+                "critical_path": _critical_path(rollups[name]),
             }
-        )
-
-        # Recurse into children first so we can roll their subtree costs up.
-        children_rows: list = []
-        children_subtree_material = 0.0
-        children_subtree_labor = 0.0
-        for child in node.get("children", []):
-            child_rows, child_material_pu, child_labor_pu = await dfs(
-                child, depth + 1, accumulated_amount * child["amount"]
-            )
-            children_rows.extend(child_rows)
-            children_subtree_material += child_material_pu * child["amount"]
-            children_subtree_labor += child_labor_pu * child["amount"]
+            for name in topNames
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not calculate lead times: {str(e)}")
+
 
+async def _iter_bom_export_rows(topName: str, db: Prisma):
+    """
+    Yield the flat BOM rows for topName in pre-order while walking the tree.
+
+    Component data and per-unit subtree costs come from the rollup engine, so
+    each row can be emitted as soon as its node is reached.
+    """
+    rollups = await compute_rollups([topName], db, with_manuals=True)
+
+    accumulated = []
+    async for node in iter_tree_nodes(topName, db):
+        name = node["name"]
+        amount = node["amount"]
+        depth = node["depth"]
+        del accumulated[depth:]
+        accumulated_amount = amount * (accumulated[-1] if accumulated else 1.0)
+        accumulated.append(accumulated_amount)
+
+        rollup = rollups.get(name)
+        comp = rollup.component if rollup else None
         if comp is None:
-            own_row = {
+            yield {
                 "component_name": name,
                 "depth": depth,
                 "material_cost": 0.0,
@@ -191,19 +142,10 @@ async def get_bom_export(
                 "location": None,
                 "has_manual": False,
             }
-            return [own_row] + children_rows, 0.0, 0.0
-
-        own_material_pu = comp.cost
-        own_labor_pu = sum(
-            s.duration * s.laborProfile.hourlyRate
-            for s in (comp.productionStages or [])
-            if s.laborProfile
-        )
+            continue
 
-        subtree_material_pu = own_material_pu + children_subtree_material
-        subtree_labor_pu = own_labor_pu + children_subtree_labor
-
-        own_row = {
+        subtree_material_pu, subtree_labor_pu = rollup.material, rollup.labor
+        yield {
             "component_name": comp.componentName,
             "depth": depth,
             "material_cost": subtree_material_pu * accumulated_amount,
@@ -218,52 +160,158 @@ async def get_bom_export(
             "has_manual": len(comp.manuals or []) > 0,
         }
 
-        # Parent row first (pre-order output), then children rows.
-        return [own_row] + children_rows, subtree_material_pu, subtree_labor_pu
 
-    tree = await get_tree(topName=topName, db=db, current_user=current_user)
-    rows, _, _ = await dfs(tree["tree"], 0, 1.0)
-    return rows
+@router.get("/bom-export", response_model=list)
+async def get_bom_export(
+    topName: str = Query(..., description="Top-level component name"),
+    stream: bool = Query(False, description="Stream rows as NDJSON while the tree is walked"),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Return a flat BOM list for the given top component with per-stage labor costs.
+
+    material_cost and labor_cost on each row are the full recursive BOM costs
+    for that node times its accumulated quantity, the same breakdown that the
+    inventory component shows via get_component_total_cost_detailed.
+    """
+    component = await db.components.find_first(where={"componentName": topName})
+    if not component:
+        raise HTTPException(status_code=404, detail=f"Component '{topName}' not found")
+
+    rows = _iter_bom_export_rows(topName, db)
+    if stream:
+        return StreamingResponse(ndjson_stream(rows), media_type="application/x-ndjson")
+    return [row async for row in rows]
 
 
-async def get_component_total_cost_detailed(
-    topName: str,
-    db: Prisma,
-    current_user
+@router.post("/explode", response_model=dict)
+async def explode_build_plan(
+    request: ExplodeRequest = Body(...),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
 ):
-    """Detailed cost breakdown used by the /analytics compat endpoint."""
+    """Aggregated leaf and intermediate requirements for a whole build plan.
+
+    Lines for the same component are added up; the shared BOM is walked
+    once for the entire plan.
+    """
     try:
-        tree = await get_tree(topName=topName, db=db, current_user=current_user)
+        plan = {}
+        for line in request.items:
+            if line.quantity < 0:
+                raise HTTPException(status_code=400, detail=f"Quantity for '{line.component}' cannot be negative")
+            plan[line.component] = plan.get(line.component, 0.0) + line.quantity
+
+        existing = await db.components.find_many(where={"componentName": {"in": list(plan)}})
+        found = {component.componentName for component in existing}
+        missing = [name for name in plan if name not in found]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Component '{missing[0]}' not found")
+
+        index = await get_bom_index(db)
+        required = explode_plan(index, plan)
+
+        leaves, intermediates = {}, {}
+        for name in sorted(required):
+            if any(amount for _, amount in index.get_children(name)):
+                intermediates[name] = required[name]
+            else:
+                leaves[name] = required[name]
+        return {"leaves": leaves, "intermediates": intermediates}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not explode build plan: {str(e)}")
 
-        total_material_cost = 0.0
-        total_labor_cost = 0.0
-        total_development_time = 0.0
 
-        async def dfs_post_order_cost(node, accumulated_amount: float = 1.0):
-            nonlocal total_material_cost, total_labor_cost, total_development_time
+@router.get("/buildable", response_model=dict)
+async def get_buildable_quantities(
+    refresh: bool = Query(False, description="Recompute instead of serving the cached answer"),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """How many units of every printer and assembly can be built from current stock."""
+    try:
+        return {"items": await get_buildable(db, use_cache=not refresh)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not compute buildable quantities: {str(e)}")
 
-            children_cost = 0.0
-            for child in node["children"]:
-                child_cost = await dfs_post_order_cost(child, accumulated_amount * child["amount"])
-                children_cost += child_cost * child["amount"]
 
-            material_cost = await _get_component_cost(node["name"], db)
-            development_time = await _get_component_duration(node["name"], db)
-            labor_cost = await _get_component_labor_cost(node["name"], db)
+@router.post("/what-if", response_model=dict)
+async def get_what_if_costs(
+    request: WhatIfRequest = Body(...),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Rolled-up costs of the printers (or the given components) under a batch of price and labor rate overrides.
 
-            total_material_cost += material_cost * accumulated_amount
-            total_labor_cost += labor_cost * accumulated_amount
-            total_development_time += development_time * accumulated_amount
+    The BOM is factorized once as a sparse (I - A) system and all scenarios
+    are solved together; the baseline uses the stored prices and rates.
+    """
+    try:
+        matrix = await load_bom_matrix(db)
+        return matrix.what_if(request.scenarios, request.components)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not calculate what-if costs: {str(e)}")
 
-            return children_cost + material_cost + labor_cost
 
-        total_calculated_cost = await dfs_post_order_cost(tree["tree"])
+@router.post("/cost-snapshot", response_model=dict)
+async def create_cost_snapshot(
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Take today's cost snapshot now instead of waiting for the daily job."""
+    try:
+        written = await take_cost_snapshot(db)
+        return {"status": "snapshot taken", "changed": written}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not take cost snapshot: {str(e)}")
+
+
+@router.get("/cost-history", response_model=dict)
+async def get_component_cost_history(
+    component: str = Query(..., description="Component name"),
+    from_date: Optional[date] = Query(None, alias="from", description="First day (inclusive)"),
+    to_date: Optional[date] = Query(None, alias="to", description="Last day (inclusive)"),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Rolled-up cost series from the daily snapshots.
+
+    Only days on which the cost changed are stored, so each point holds
+    until the next one.
+    """
+    try:
+        start = datetime.combine(from_date, time.min) if from_date else None
+        end = datetime.combine(to_date, time.min) if to_date else None
+        return {
+            "component": component,
+            "points": await get_cost_history(component, db, start, end)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not load cost history: {str(e)}")
+
+
+async def get_component_total_cost_detailed(
+    topName: str,
+    db: Prisma,
+    current_user
+):
+    """Detailed cost breakdown used by the /analytics compat endpoint."""
+    try:
+        rollup = await _get_rollup(topName, db)
 
         return {
-            "total_cost": total_calculated_cost,
-            "material_cost": total_material_cost,
-            "labor_cost": total_labor_cost,
-            "total_development_time": total_development_time,
+            "total_cost": rollup.total,
+            "material_cost": rollup.material,
+            "labor_cost": rollup.labor,
+            "total_development_time": rollup.duration,
             "component_name": topName
         }
 
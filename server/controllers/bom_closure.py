@@ -0,0 +1,282 @@
+import asyncio
+import sys
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, List, Set, Tuple
+from fastapi import APIRouter, Depends, HTTPException
+from prisma import Prisma
+
+from .auth.auth import get_current_user
+from .auth.models import User
+from .database import get_db
+from .bom_index import BomIndex, bom_index, get_bom_index
+from .rollup import rollup_cache
+
+router = APIRouter(prefix="/bom-closure", tags=["bom-closure"])
+
+# Rows are written in chunks so a full rebuild never sends one huge statement
+CLOSURE_CHUNK_SIZE = 5000
+
+
+def closure_scope(index: BomIndex, top_component: str, sub_component: str) -> Tuple[Set[str], Set[str]]:
+    """
+    Closure pairs that can change when the edge top -> sub changes: every
+    ancestor of top (and top itself) against every descendant of sub (and sub).
+    """
+    return _walk(index.get_parents, top_component), _walk(index.get_children, sub_component)
+
+
+def component_scope(index: BomIndex, component_name: str) -> Tuple[Set[str], Set[str]]:
+    """Closure pairs that can change when a component and all its edges go away."""
+    return _walk(index.get_parents, component_name), _walk(index.get_children, component_name)
+
+
+def _walk(neighbours, start: str) -> Set[str]:
+    seen = {start}
+    stack = [start]
+    while stack:
+        for name, _ in neighbours(stack.pop()):
+            if name not in seen:
+                seen.add(name)
+                stack.append(name)
+    return seen
+
+
+def compute_closure_rows(index: BomIndex, ancestors: Iterable[str], descendants: Set[str] = None) -> List[dict]:
+    """
+    Closure rows for the given ancestors from the in-memory index.
+
+    quantityPer is the quantity of the descendant per unit of the ancestor,
+    summed over every path; depth is the shortest path length. When
+    descendants is given, only pairs ending in that set are computed.
+    """
+    memo: Dict[str, Dict[str, List[float]]] = {}
+    in_progress = set()
+
+    def reach(name: str) -> Dict[str, List[float]]:
+        if name in memo:
+            return memo[name]
+        if name in in_progress:
+            return {}
+        in_progress.add(name)
+
+        result: Dict[str, List[float]] = {}
+        for sub_component, amount in index.get_children(name):
+            if descendants is None or sub_component in descendants:
+                _accumulate(result, sub_component, amount, 1)
+            for descendant, (quantity, depth) in reach(sub_component).items():
+                _accumulate(result, descendant, amount * quantity, depth + 1)
+        result.pop(name, None)
+
+        in_progress.discard(name)
+        memo[name] = result
+        return result
+
+    rows = []
+    for ancestor in ancestors:
+        for descendant, (quantity, depth) in reach(ancestor).items():
+            rows.append({
+                "ancestor": ancestor,
+                "descendant": descendant,
+                "depth": int(depth),
+                "quantityPer": quantity,
+            })
+    return rows
+
+
+def _accumulate(result: Dict[str, List[float]], descendant: str, quantity: float, depth: int):
+    entry = result.get(descendant)
+    if entry is None:
+        result[descendant] = [quantity, depth]
+    else:
+        entry[0] += quantity
+        entry[1] = min(entry[1], depth)
+
+
+async def write_closure_rows(client, index: BomIndex, ancestors: Set[str], descendants: Set[str]):
+    """Recompute and rewrite the closure rows for ancestors x descendants through client."""
+    rows = compute_closure_rows(index, ancestors, descendants)
+    await client.bomclosure.delete_many(
+        where={
+            "ancestor": {"in": list(ancestors)},
+            "descendant": {"in": list(descendants)}
+        }
+    )
+    for start in range(0, len(rows), CLOSURE_CHUNK_SIZE):
+        await client.bomclosure.create_many(data=rows[start:start + CLOSURE_CHUNK_SIZE])
+
+
+async def sync_edge_closure(transaction, top_component: str, sub_component: str):
+    """
+    Bring the closure table in line after the edge top -> sub was created,
+    updated or removed. Runs in the transaction of the edge write, after
+    the index was patched, so the edge and its closure commit together.
+    """
+    index = await get_bom_index(transaction)
+    ancestors, descendants = closure_scope(index, top_component, sub_component)
+    await write_closure_rows(transaction, index, ancestors, descendants)
+
+
+# The app runs a single worker, so one lock serializes every write to
+# Relationships: closure rows are never rewritten by two transactions at
+# once and never computed from another transaction's uncommitted edge
+edge_write_lock = asyncio.Lock()
+
+
+@asynccontextmanager
+async def edge_transaction(db: Prisma):
+    """
+    Serialized transaction for writes to Relationships. The index is loaded
+    before it opens and patched inside it, ahead of the commit, so the
+    closure can be computed from it; if the transaction fails after the
+    index was patched, the index is dropped and reloads from the database.
+    """
+    async with edge_write_lock:
+        await get_bom_index(db)
+        revision = bom_index.revision
+        try:
+            async with db.tx() as transaction:
+                yield transaction
+        except Exception:
+            if bom_index.revision != revision:
+                bom_index.invalidate()
+                rollup_cache.clear()
+            raise
+
+
+async def rename_closure_component(client, old_name: str, new_name: str):
+    await client.bomclosure.update_many(
+        where={"ancestor": old_name},
+        data={"ancestor": new_name}
+    )
+    await client.bomclosure.update_many(
+        where={"descendant": old_name},
+        data={"descendant": new_name}
+    )
+
+
+async def rebuild_closure(db: Prisma) -> int:
+    """
+    Rebuild the whole closure table from the Relationships table. The
+    process-wide index is reloaded first, so edits made to the database
+    out of band show up everywhere, not only in the closure.
+    """
+    async with edge_write_lock:
+        bom_index.invalidate()
+        rollup_cache.clear()
+        index = await get_bom_index(db)
+        rows = compute_closure_rows(index, list(index.children))
+
+        async with db.tx() as transaction:
+            await transaction.bomclosure.delete_many()
+            for start in range(0, len(rows), CLOSURE_CHUNK_SIZE):
+                await transaction.bomclosure.create_many(data=rows[start:start + CLOSURE_CHUNK_SIZE])
+
+    return len(rows)
+
+
+def _edges(index: BomIndex) -> Dict[str, Dict[str, float]]:
+    return {name: children for name, children in index.children.items() if children}
+
+
+async def check_closure(db: Prisma) -> dict:
+    """
+    Compare the stored closure table against one computed from Relationships.
+    The process-wide index is compared as well and reloaded if it is stale.
+    """
+    index = BomIndex()
+    async with edge_write_lock:
+        await index.ensure_loaded(db)
+        index_consistent = not bom_index.loaded or _edges(bom_index) == _edges(index)
+        if not index_consistent:
+            bom_index.invalidate()
+            rollup_cache.clear()
+    expected = {
+        (row["ancestor"], row["descendant"]): row
+        for row in compute_closure_rows(index, list(index.children))
+    }
+    stored = {
+        (row.ancestor, row.descendant): row
+        for row in await db.bomclosure.find_many()
+    }
+
+    missing = [{"ancestor": a, "descendant": d} for (a, d) in expected if (a, d) not in stored]
+    extra = [{"ancestor": a, "descendant": d} for (a, d) in stored if (a, d) not in expected]
+    mismatched = []
+    for key, row in expected.items():
+        current = stored.get(key)
+        if current is None:
+            continue
+        if current.depth != row["depth"] or abs(current.quantityPer - row["quantityPer"]) > 1e-9:
+            mismatched.append({
+                "ancestor": key[0],
+                "descendant": key[1],
+                "expectedDepth": row["depth"],
+                "storedDepth": current.depth,
+                "expectedQuantityPer": row["quantityPer"],
+                "storedQuantityPer": current.quantityPer,
+            })
+
+    return {
+        "consistent": not (missing or extra or mismatched),
+        "indexConsistent": index_consistent,
+        "expectedRows": len(expected),
+        "storedRows": len(stored),
+        "missing": missing,
+        "extra": extra,
+        "mismatched": mismatched,
+    }
+
+
+async def ensure_closure_built(db: Prisma):
+    """Populate an empty closure table on startup, e.g. right after the table was added."""
+    if await db.bomclosure.count() == 0 and await db.relationships.count() > 0:
+        count = await rebuild_closure(db)
+        print(f"✅ BOM closure built ({count} rows)")
+
+
+@router.post("/rebuild", response_model=dict)
+async def rebuild_closure_endpoint(
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        count = await rebuild_closure(db)
+        return {"status": "rebuilt", "rows": count}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not rebuild BOM closure: {str(e)}")
+
+
+@router.get("/check", response_model=dict)
+async def check_closure_endpoint(
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        return await check_closure(db)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not check BOM closure: {str(e)}")
+
+
+async def _main(command: str):
+    from .database import prisma
+    await prisma.connect()
+    try:
+        if command == "rebuild":
+            print(f"Rebuilt BOM closure: {await rebuild_closure(prisma)} rows")
+        else:
+            report = await check_closure(prisma)
+            print(
+                f"consistent={report['consistent']} expected={report['expectedRows']} stored={report['storedRows']} "
+                f"missing={len(report['missing'])} extra={len(report['extra'])} mismatched={len(report['mismatched'])}"
+            )
+    finally:
+        await prisma.disconnect()
+
+
+if __name__ == "__main__":
+    # Usage (from server/): python -m controllers.bom_closure [rebuild|check]
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if command not in ("rebuild", "check"):
+        print("Usage: python -m controllers.bom_closure [rebuild|check]")
+        sys.exit(1)
+    asyncio.run(_main(command))
@@ -0,0 +1,134 @@
+import asyncio
+from typing import Dict, List, Tuple
+from fastapi import HTTPException
+from prisma import Prisma
+
+
+class BomIndex:
+    """
+    Process-wide in-memory copy of the Relationships table.
+
+    The whole table is loaded once into parent -> children and child -> parents
+    maps. Every write path that touches Relationships patches the index right
+    after the database write succeeds, so tree builds never have to go back to
+    the database for edges.
+    """
+
+    def __init__(self):
+        self.children: Dict[str, Dict[str, float]] = {}
+        self.parents: Dict[str, Dict[str, float]] = {}
+        self.loaded = False
+        # Bumped on every change, so derived data can tell it is out of date
+        self.revision = 0
+        self._lock = asyncio.Lock()
+
+    async def ensure_loaded(self, db: Prisma) -> "BomIndex":
+        if self.loaded:
+            return self
+        async with self._lock:
+            if not self.loaded:
+                relationships = await db.relationships.find_many()
+                self.children = {}
+                self.parents = {}
+                for rel in relationships:
+                    self._link(rel.topComponent, rel.subComponent, rel.amount)
+                self.loaded = True
+                self.revision += 1
+        return self
+
+    def invalidate(self):
+        """Drop the index; the next read reloads it from the database."""
+        self.loaded = False
+        self.revision += 1
+        self.children = {}
+        self.parents = {}
+
+    def snapshot(self) -> "BomIndex":
+        """Loaded copy of the edges, safe to read from another thread while this one is patched."""
+        copy = BomIndex()
+        copy.children = {name: dict(children) for name, children in self.children.items()}
+        copy.parents = {name: dict(parents) for name, parents in self.parents.items()}
+        copy.loaded = True
+        copy.revision = self.revision
+        return copy
+
+    def get_children(self, component_name: str) -> List[Tuple[str, float]]:
+        return list(self.children.get(component_name, {}).items())
+
+    def get_parents(self, component_name: str) -> List[Tuple[str, float]]:
+        return list(self.parents.get(component_name, {}).items())
+
+    def would_create_cycle(self, top_component: str, sub_component: str) -> bool:
+        """True if adding top -> sub closes a loop, i.e. sub already reaches top."""
+        if top_component == sub_component:
+            return True
+        seen = {sub_component}
+        stack = [sub_component]
+        while stack:
+            for child, _ in self.get_children(stack.pop()):
+                if child == top_component:
+                    return True
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return False
+
+    def set_edge(self, top_component: str, sub_component: str, amount: float):
+        self.revision += 1
+        if self.loaded:
+            self._link(top_component, sub_component, amount)
+
+    def remove_edge(self, top_component: str, sub_component: str):
+        self.revision += 1
+        if not self.loaded:
+            return
+        self.children.get(top_component, {}).pop(sub_component, None)
+        self.parents.get(sub_component, {}).pop(top_component, None)
+
+    def remove_component(self, component_name: str):
+        self.revision += 1
+        if not self.loaded:
+            return
+        for sub_component in list(self.children.pop(component_name, {})):
+            self.parents.get(sub_component, {}).pop(component_name, None)
+        for top_component in list(self.parents.pop(component_name, {})):
+            self.children.get(top_component, {}).pop(component_name, None)
+
+    def rename_component(self, old_name: str, new_name: str):
+        self.revision += 1
+        if not self.loaded:
+            return
+        children = self.children.pop(old_name, {})
+        parents = self.parents.pop(old_name, {})
+        for sub_component, amount in children.items():
+            self.parents.get(sub_component, {}).pop(old_name, None)
+            self._link(new_name, sub_component, amount)
+        for top_component, amount in parents.items():
+            self.children.get(top_component, {}).pop(old_name, None)
+            self._link(top_component, new_name, amount)
+
+    def _link(self, top_component: str, sub_component: str, amount: float):
+        self.children.setdefault(top_component, {})[sub_component] = amount
+        self.parents.setdefault(sub_component, {})[top_component] = amount
+
+
+# Global BOM index instance
+bom_index = BomIndex()
+
+
+async def get_bom_index(db: Prisma) -> BomIndex:
+    return await bom_index.ensure_loaded(db)
+
+
+async def ensure_no_cycle(db: Prisma, top_component: str, sub_component: str):
+    """
+    Reject an edge that would make the BOM cyclic. Call it inside
+    edge_transaction, right before the write, so no other edge can land
+    between the check and the write.
+    """
+    index = await get_bom_index(db)
+    if index.would_create_cycle(top_component, sub_component):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Relationship '{top_component}' -> '{sub_component}' would create a circular reference"
+        )
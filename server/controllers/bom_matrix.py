@@ -0,0 +1,136 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+from prisma import Prisma
+from prisma.enums import TypeOfComponent
+from scipy.sparse import csc_matrix, identity
+from scipy.sparse.linalg import splu
+
+from models import WhatIfScenario
+from .bom_index import BomIndex, get_bom_index
+from .rollup import explode_plan
+
+
+class BomMatrix:
+    """
+    The BOM as a sparse linear system.
+
+    A[i, j] is the quantity of component j in one unit of component i, so the
+    rolled-up per-unit cost vector x satisfies x = c + A x, i.e. (I - A) x = c.
+    I - A is factorized once and every cost vector (material prices, or labor
+    as stage hours per profile times hourly rates) is a right-hand side of
+    the same factorization.
+    """
+
+    def __init__(self, index: BomIndex, components: list, labor_profiles: list):
+        names = {component.componentName for component in components}
+        names.update(index.children)
+        names.update(index.parents)
+        self.names: List[str] = sorted(names)
+        self.position = {name: i for i, name in enumerate(self.names)}
+        size = len(self.names)
+
+        rows, cols, amounts = [], [], []
+        for top_component, children in index.children.items():
+            for sub_component, amount in children.items():
+                if amount:
+                    rows.append(self.position[top_component])
+                    cols.append(self.position[sub_component])
+                    amounts.append(amount)
+        # A cycle can leave I - A invertible (e.g. a 2x loop) and give negative
+        # costs, so it is checked on the graph instead of relying on splu
+        try:
+            explode_plan(index, {name: 1.0 for name in index.children})
+        except ValueError:
+            raise ValueError("The BOM contains a circular reference; costs cannot be rolled up")
+        quantities = csc_matrix((amounts, (rows, cols)), shape=(size, size))
+        self.lu = splu((identity(size, format="csc") - quantities).tocsc()) if size else None
+
+        # Profiles can be addressed by id or by name
+        self.profile_position = {profile.id: i for i, profile in enumerate(labor_profiles)}
+        self.profile_position.update({profile.name: i for i, profile in enumerate(labor_profiles)})
+        self.rates = np.array([profile.hourlyRate for profile in labor_profiles], dtype=float)
+
+        self.material = np.zeros(size)
+        stage_rows, stage_cols, hours = [], [], []
+        for component in components:
+            i = self.position[component.componentName]
+            self.material[i] = component.cost
+            for stage in component.productionStages or []:
+                if stage.laborProfileId in self.profile_position:
+                    stage_rows.append(i)
+                    stage_cols.append(self.profile_position[stage.laborProfileId])
+                    hours.append(stage.duration)
+        # S[i, p]: hours component i itself spends on stages billed at profile p
+        self.stage_hours = csc_matrix((hours, (stage_rows, stage_cols)), shape=(size, len(labor_profiles)))
+
+        # Default targets: the printers, or if there are none, built items nothing
+        # else uses (canvas placeholders and loose parts have no children)
+        self.top_level = sorted(
+            component.componentName for component in components
+            if component.type == TypeOfComponent.printer
+        ) or sorted(
+            component.componentName for component in components
+            if not any(index.parents.get(component.componentName, {}).values())
+            and any(index.children.get(component.componentName, {}).values())
+        )
+
+    def what_if(self, scenarios: List[WhatIfScenario], top_names: Optional[List[str]] = None) -> dict:
+        """
+        Rolled-up costs of top_names (default: the printers) for the
+        baseline and each scenario, from a single solve with two right-hand
+        sides (material, labor) per scenario.
+        """
+        top_names = self.top_level if top_names is None else top_names
+        unknown = [name for name in top_names if name not in self.position]
+        if unknown:
+            raise KeyError(f"Component '{unknown[0]}' not found")
+        targets = [self.position[name] for name in top_names]
+
+        count = len(scenarios) + 1
+        material = np.repeat(self.material[:, None], count, axis=1)
+        rates = np.repeat(self.rates[:, None], count, axis=1)
+        for column, scenario in enumerate(scenarios, start=1):
+            for name, price in scenario.prices.items():
+                if name not in self.position:
+                    raise ValueError(f"Scenario {column}: unknown component '{name}'")
+                material[self.position[name], column] = price
+            for profile, rate in scenario.rates.items():
+                if profile not in self.profile_position:
+                    raise ValueError(f"Scenario {column}: unknown labor profile '{profile}'")
+                rates[self.profile_position[profile], column] = rate
+
+        labor = self.stage_hours @ rates
+        if self.lu is not None:
+            solution = self.lu.solve(np.hstack([material, labor]))
+        else:
+            solution = np.zeros((0, 2 * count))
+        rolled_material = solution[targets, :count]
+        rolled_labor = solution[targets, count:]
+
+        def costs(column: int) -> Dict[str, dict]:
+            return {
+                name: {
+                    "material_cost": float(rolled_material[row, column]),
+                    "labor_cost": float(rolled_labor[row, column]),
+                    "total_cost": float(rolled_material[row, column] + rolled_labor[row, column]),
+                }
+                for row, name in enumerate(top_names)
+            }
+
+        return {
+            "components": top_names,
+            "baseline": costs(0),
+            "scenarios": [
+                {"name": scenario.name or f"Scenario {column}", "costs": costs(column)}
+                for column, scenario in enumerate(scenarios, start=1)
+            ],
+        }
+
+
+async def load_bom_matrix(db: Prisma) -> BomMatrix:
+    """Edges from the BOM index, one query for components with stages, one for labor profiles."""
+    index = await get_bom_index(db)
+    components = await db.components.find_many(include={"productionStages": True})
+    labor_profiles = await db.laborprofile.find_many()
+    return BomMatrix(index, components, labor_profiles)
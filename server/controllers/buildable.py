@@ -0,0 +1,210 @@
+import math
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from fastapi.concurrency import run_in_threadpool
+from prisma import Prisma
+from prisma.enums import TypeOfComponent
+
+from .bom_index import BomIndex, get_bom_index
+from .rollup import explode_plan, rollup_cache
+
+# Types reported by /analytics/buildable
+BUILDABLE_TYPES = (TypeOfComponent.printer, TypeOfComponent.assembly)
+
+
+def _independent_bounds(index: BomIndex, stock: Dict[str, float]) -> Dict[str, int]:
+    """
+    Buildable units when every child could use the whole stock on its own:
+    min over children of floor((stock(child) + bound(child)) / amount).
+    Sharing stock between siblings only lowers this, so it caps the search.
+    """
+    bounds: Dict[str, int] = {}
+    on_path = set()
+
+    def visit(name: str) -> int:
+        if name in bounds:
+            return bounds[name]
+
+        children = [(sub_component, amount) for sub_component, amount in index.get_children(name) if amount > 0]
+        if not children:
+            bounds[name] = 0
+            return 0
+
+        on_path.add(name)
+        best = None
+        for sub_component, amount in children:
+            # A legacy cycle back into the path only counts the stock on hand
+            built = 0 if sub_component in on_path else visit(sub_component)
+            units = math.floor((stock.get(sub_component, 0.0) + built) / amount + 1e-9)
+            best = units if best is None else min(best, units)
+        on_path.discard(name)
+
+        bounds[name] = max(best, 0)
+        return bounds[name]
+
+    for name in list(index.children):
+        visit(name)
+    return bounds
+
+
+def _shortages(index: BomIndex, name: str, quantity: int, stock: Dict[str, float]) -> List[str]:
+    """Bought parts that run short when quantity of name is built from stock."""
+    required = explode_plan(index, {name: quantity}, on_hand=stock)
+    return sorted(
+        (
+            sub_component for sub_component, needed in required.items()
+            if sub_component != name
+            and not any(amount > 0 for _, amount in index.get_children(sub_component))
+            and needed > stock.get(sub_component, 0.0) + 1e-9
+        ),
+        key=lambda sub_component: (stock.get(sub_component, 0.0) - required[sub_component], sub_component)
+    )
+
+
+def compute_buildable(
+    index: BomIndex,
+    stock: Dict[str, float],
+    names: Optional[Iterable[str]] = None
+) -> Dict[str, Tuple[int, Optional[str]]]:
+    """
+    Units of each assembly buildable from current stock, with the part
+    that limits it. When names is given, only those are computed.
+
+    Each candidate quantity is exploded against one stock snapshot: stock
+    of intermediate assemblies is used first and only the rest is built,
+    so parts shared between siblings are only counted once. The largest
+    quantity whose bought parts all fit is found by binary search; the
+    limiting part is the one that runs shortest one unit above it.
+    """
+    results: Dict[str, Tuple[int, Optional[str]]] = {}
+    bounds = _independent_bounds(index, stock)
+    for name in (bounds if names is None else names):
+        bound = bounds.get(name, 0)
+        if not any(amount > 0 for _, amount in index.get_children(name)):
+            # Bought parts cannot be built, only taken from stock
+            results[name] = (0, None)
+            continue
+
+        try:
+            low, high = 0, bound
+            while low < high:
+                middle = (low + high + 1) // 2
+                if _shortages(index, name, middle, stock):
+                    high = middle - 1
+                else:
+                    low = middle
+            short = _shortages(index, name, low + 1, stock)
+        except ValueError:
+            # Legacy cycle below the assembly: nothing can be planned through it
+            results[name] = (0, None)
+            continue
+
+        results[name] = (low, short[0] if short else None)
+    return results
+
+
+def _affected(index: BomIndex, changed: Set[str]) -> Set[str]:
+    """The changed components and every assembly above them."""
+    seen = set(changed)
+    stack = list(changed)
+    while stack:
+        for top_component, _ in index.get_parents(stack.pop()):
+            if top_component not in seen:
+                seen.add(top_component)
+                stack.append(top_component)
+    return seen
+
+
+class BuildableCache:
+    """
+    The last /analytics/buildable answer, plus the per-assembly results and
+    the stock snapshot it was computed from. Stock writes call invalidate(),
+    which drops the answer but keeps the results: the next call only
+    recomputes the assemblies above components whose stock moved. BOM and
+    component writes bump the rollup cache generation, which retires both.
+    """
+
+    def __init__(self):
+        self.items: Optional[List[dict]] = None
+        self.generation = 0
+        self.rollup_generation = None
+        self.results: Optional[Dict[str, Tuple[int, Optional[str]]]] = None
+        self.stock: Dict[str, float] = {}
+
+    def get(self) -> Optional[List[dict]]:
+        if self.items is not None and self.rollup_generation == rollup_cache.generation:
+            return self.items
+        return None
+
+    def get_results(self) -> Tuple[Optional[Dict[str, Tuple[int, Optional[str]]]], Dict[str, float]]:
+        if self.results is not None and self.rollup_generation == rollup_cache.generation:
+            return self.results, self.stock
+        return None, {}
+
+    def store(
+        self,
+        items: List[dict],
+        results: Dict[str, Tuple[int, Optional[str]]],
+        stock: Dict[str, float],
+        generation: int,
+        rollup_generation: int
+    ):
+        if rollup_generation != rollup_cache.generation:
+            return
+        # Results match the stock they were computed from even if a scan landed meanwhile
+        self.results = results
+        self.stock = stock
+        self.rollup_generation = rollup_generation
+        self.items = items if generation == self.generation else None
+
+    def invalidate(self):
+        self.generation += 1
+        self.items = None
+
+
+# Global buildable cache instance
+buildable_cache = BuildableCache()
+
+
+async def get_buildable(db: Prisma, use_cache: bool = True) -> List[dict]:
+    """
+    Buildable units for every printer and assembly, from one stock snapshot
+    and the BOM index. The search runs in a worker thread so it never holds
+    up the event loop.
+    """
+    if use_cache:
+        cached = buildable_cache.get()
+        if cached is not None:
+            return cached
+
+    generation, rollup_generation = buildable_cache.generation, rollup_cache.generation
+    index = (await get_bom_index(db)).snapshot()
+    components = await db.components.find_many()
+    stock = {component.componentName: component.amount for component in components}
+
+    previous, previous_stock = buildable_cache.get_results() if use_cache else (None, {})
+    if previous is None:
+        results = await run_in_threadpool(compute_buildable, index, stock)
+    else:
+        changed = {
+            name for name in stock.keys() | previous_stock.keys()
+            if stock.get(name) != previous_stock.get(name)
+        }
+        results = dict(previous)
+        if changed:
+            results.update(await run_in_threadpool(compute_buildable, index, stock, _affected(index, changed)))
+
+    items = []
+    for component in sorted(components, key=lambda c: c.componentName):
+        if component.type not in BUILDABLE_TYPES:
+            continue
+        buildable, limiting = results.get(component.componentName, (0, None))
+        items.append({
+            "componentName": component.componentName,
+            "type": component.type,
+            "inStock": component.amount,
+            "buildable": buildable,
+            "limitingComponent": limiting,
+        })
+
+    buildable_cache.store(items, results, stock, generation, rollup_generation)
+    return items
@@ -11,36 +11,38 @@ from prisma.errors import RecordNotFoundError
 from .auth.auth import get_current_user
 from .auth.models import User
 from .database import get_db
-from models import Component, ComponentCreate, ComponentUpdate, ComponentTree, TreeNode, GraphData, Node, NodeData, Edge, ComponentName, ComponentNameOnly
-from controllers.analytics import get_component_total_cost_detailed
+from .bom_index import bom_index, ensure_no_cycle
+from .bom_closure import component_scope, edge_transaction, rename_closure_component, sync_edge_closure, write_closure_rows
+from .sync import append_changes, change, component_changes, record_changes
+from models import Component, ComponentCreate, ComponentUpdate, ComponentTree, TreeNode, GraphData, Node, NodeData, Edge, ComponentName, ComponentNameOnly, ComponentHistory, StockMovementSource, ChangeEntity
+from controllers.buildable import buildable_cache
+from controllers.rollup import compute_catalog_rollups, rollup_cache
+from controllers.stockupdate import record_movement
 
 router = APIRouter(prefix="/components", tags=["components"])
 
 @router.get("/export/csv")
 async def export_components_csv(
-    hourly_rate: float = Query(18.5, description="Hourly rate for cost calculation in EUR"),
     db: Prisma = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     try:
-        components = await db.components.find_many()
+        # One pass over the whole BOM; every component's cost is computed once
+        rollups = await compute_catalog_rollups(db)
         
         output = io.StringIO()
         writer = csv.writer(output, delimiter=';')
         writer.writerow(["Component name", "Material cost", "Labor cost", "Total cost"])
         
-        for comp in components:
-            try:
-                cost_data = await get_component_total_cost_detailed(comp.componentName, hourly_rate, db, current_user)
-                writer.writerow([
-                    comp.componentName,
-                    f"{cost_data['material_cost']:.2f}",
-                    f"{cost_data['labor_cost']:.2f}",
-                    f"{cost_data['total_cost']:.2f}"
-                ])
-            except Exception as e:
-                # Fallback if cost calculation fails for a specific component
-                writer.writerow([comp.componentName, "Error", "Error", "Error"])
+        for name, rollup in rollups.items():
+            if not rollup.found:
+                continue
+            writer.writerow([
+                name,
+                f"{rollup.material:.2f}",
+                f"{rollup.labor:.2f}",
+                f"{rollup.total:.2f}"
+            ])
         
         output.seek(0)
         return StreamingResponse(
@@ -311,6 +313,23 @@ async def get_component(
     except RecordNotFoundError:
         raise HTTPException(status_code=404, detail=f"Component '{component_name}' not found")
 
+@router.get("/component/{component_name}/history", response_model=List[ComponentHistory])
+async def get_component_history(
+    component_name: str,
+    limit: int = Query(100, ge=1, le=1000, description="Most recent movements to return"),
+    db: Prisma = Depends(get_db), 
+    current_user: User = Depends(get_current_user)
+):
+    """Stock movements of one component, newest first."""
+    try:
+        return await db.componenthistory.find_many(
+            where={"componentName": component_name},
+            order={"scanned": "desc"},
+            take=limit
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not load stock history: {str(e)}")
+
 @router.post("/", response_model=Component)
 async def create_component(
     root: str = Query(...),
@@ -349,13 +368,19 @@ async def create_component(
                 )
                 
                 if not existing_rel:
-                    await db.relationships.create(
-                        data={
-                            "topComponent": root,
-                            "subComponent": component.componentName,
-                            "amount": 0
-                        }
-                    )
+                    async with edge_transaction(db) as transaction:
+                        await ensure_no_cycle(transaction, root, component.componentName)
+                        await transaction.relationships.create(
+                            data={
+                                "topComponent": root,
+                                "subComponent": component.componentName,
+                                "amount": 0
+                            }
+                        )
+                        bom_index.set_edge(root, component.componentName, 0)
+                        await sync_edge_closure(transaction, root, component.componentName)
+                        await append_changes(transaction, change(ChangeEntity.relationship, root, component.componentName))
+                    rollup_cache.invalidate(root)
             return existing
         
         else:
@@ -383,21 +408,37 @@ async def create_component(
                     stage_data["laborProfileId"] = stage.laborProfileId
                 await db.productionstage.create(data=stage_data)
             
+            changes = [change(ChangeEntity.component, created.componentName)]
+            if production_stages:
+                changes.append(change(ChangeEntity.stage, created.componentName))
+            
             try:
                 if root and root != component.componentName:
-                    await db.relationships.create(
-                        data={
-                            "topComponent": root,
-                            "subComponent": created.componentName,
-                            "amount": 0
-                        }
-                    )
+                    async with edge_transaction(db) as transaction:
+                        await transaction.relationships.create(
+                            data={
+                                "topComponent": root,
+                                "subComponent": created.componentName,
+                                "amount": 0
+                            }
+                        )
+                        bom_index.set_edge(root, created.componentName, 0)
+                        await sync_edge_closure(transaction, root, created.componentName)
+                        await append_changes(
+                            transaction,
+                            *changes,
+                            change(ChangeEntity.relationship, root, created.componentName)
+                        )
+                else:
+                    await record_changes(db, *changes)
             except Exception as rel_error:
                 await db.components.delete(
                     where={"componentName": created.componentName}
                 )
                 raise Exception(f"Failed to create relationship: {str(rel_error)}")
             
+            rollup_cache.invalidate(created.componentName, root)
+
             # Fetch the created component with its production stages
             result = await db.components.find_unique(
                 where={"componentName": created.componentName},
@@ -405,6 +446,8 @@ async def create_component(
             )
             return result
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -438,6 +481,7 @@ async def update_component(
         }
         
         update_data["lastScanned"] = datetime.utcnow()
+        changes = []
 
         # Handle component rename if requested
         if new_component_name and new_component_name != component_name:
@@ -452,13 +496,28 @@ async def update_component(
                 )
             
             # Update all references to this component in Relationships table
-            await db.relationships.update_many(
-                where={"topComponent": component_name},
-                data={"topComponent": new_component_name}
+            async with edge_transaction(db) as transaction:
+                await transaction.relationships.update_many(
+                    where={"topComponent": component_name},
+                    data={"topComponent": new_component_name}
+                )
+                await transaction.relationships.update_many(
+                    where={"subComponent": component_name},
+                    data={"subComponent": new_component_name}
+                )
+                # Clients drop everything under the old name and receive it again under the new one
+                changes += component_changes(bom_index, component_name, deleted=True)
+                bom_index.rename_component(component_name, new_component_name)
+                changes += component_changes(bom_index, new_component_name)
+                await rename_closure_component(transaction, component_name, new_component_name)
+            
+            # Move the cost history along; rows left by an earlier component of that name are dropped
+            await db.costsnapshot.delete_many(
+                where={"componentName": new_component_name}
             )
-            await db.relationships.update_many(
-                where={"subComponent": component_name},
-                data={"subComponent": new_component_name}
+            await db.costsnapshot.update_many(
+                where={"componentName": component_name},
+                data={"componentName": new_component_name}
             )
             
             # Update references in ComponentHistory table
@@ -519,6 +578,31 @@ async def update_component(
                     stage_data["laborProfileId"] = stage.laborProfileId
                 await db.productionstage.create(data=stage_data)
         
+        if "amount" in update_data and updated.amount != existing.amount:
+            record_movement(
+                updated.componentName,
+                updated.amount,
+                updated.amount - existing.amount,
+                current_user.username,
+                StockMovementSource.manual
+            )
+        
+        # Only cost, delivery time, stages and the name feed the rollups above it
+        renamed = updated.componentName != component_name
+        if (
+            renamed
+            or updated.cost != existing.cost
+            or updated.delivery_time != existing.delivery_time
+            or production_stages is not None
+        ):
+            rollup_cache.invalidate(updated.componentName, component_name)
+        if updated.amount != existing.amount or updated.type != existing.type:
+            buildable_cache.invalidate()
+        changes.append(change(ChangeEntity.component, updated.componentName))
+        if production_stages is not None:
+            changes.append(change(ChangeEntity.stage, updated.componentName))
+        await record_changes(db, *changes)
+        
         # Fetch updated component with production stages
         result = await db.components.find_unique(
             where={"componentName": updated.componentName},
@@ -556,18 +640,26 @@ async def delete_component(
     
     if deleteOutOfDatabase:
         try:
-            await db.relationships.delete_many(
-                where={
-                    "OR": [
-                        {"topComponent": componentName},
-                        {"subComponent": componentName}
-                    ]
-                }
-            )
+            async with edge_transaction(db) as transaction:
+                ancestors, descendants = component_scope(bom_index, componentName)
+                # Tombstones are taken before the edges leave the index and written once they are gone
+                tombstones = component_changes(bom_index, componentName, deleted=True)
+                await transaction.relationships.delete_many(
+                    where={
+                        "OR": [
+                            {"topComponent": componentName},
+                            {"subComponent": componentName}
+                        ]
+                    }
+                )
+                bom_index.remove_component(componentName)
+                await write_closure_rows(transaction, bom_index, ancestors, descendants)
 
-            await db.components.delete(
-                where={"componentName": componentName}
-            )
+                await transaction.components.delete(
+                    where={"componentName": componentName}
+                )
+                await append_changes(transaction, *tombstones)
+            rollup_cache.invalidate(*ancestors)
             
             return component
         
@@ -584,14 +676,19 @@ async def delete_component(
             )
     else:
         try:      
-            await db.relationships.delete(
-                where={
-                    "topComponent_subComponent": {
-                        "topComponent": parent,
-                        "subComponent": componentName
+            async with edge_transaction(db) as transaction:
+                await transaction.relationships.delete(
+                    where={
+                        "topComponent_subComponent": {
+                            "topComponent": parent,
+                            "subComponent": componentName
+                        }
                     }
-                }
-            )
+                )
+                bom_index.remove_edge(parent, componentName)
+                await sync_edge_closure(transaction, parent, componentName)
+                await append_changes(transaction, change(ChangeEntity.relationship, parent, componentName, deleted=True))
+            rollup_cache.invalidate(parent)
             return component
             
         except RecordNotFoundError:
@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+from prisma import Prisma
+
+from .rollup import compute_catalog_rollups
+
+# Values closer than this to the last snapshot count as unchanged
+SNAPSHOT_TOLERANCE = 1e-6
+SNAPSHOT_CHUNK_SIZE = 5000
+
+# Latest stored snapshot per component, read once per run
+LATEST_SNAPSHOTS_QUERY = """
+SELECT DISTINCT ON ("componentName")
+    "componentName",
+    "materialCost",
+    "laborCost",
+    day = $1::timestamp AS is_today
+FROM "CostSnapshot"
+ORDER BY "componentName", day DESC
+"""
+
+_snapshot_task: Optional[asyncio.Task] = None
+
+
+def snapshot_day(moment: datetime = None) -> datetime:
+    """Start of the UTC day a snapshot taken at moment belongs to."""
+    moment = moment or datetime.utcnow()
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def take_cost_snapshot(db: Prisma) -> int:
+    """
+    Store today's rolled-up cost for every component whose cost changed
+    since its last snapshot; returns the number of components written.
+
+    Costs come from one whole-catalog rollup pass. A series is only written
+    when its value moves, so the value on any day is the latest snapshot on
+    or before it.
+    """
+    day = snapshot_day()
+    rollups = await compute_catalog_rollups(db)
+    latest = {
+        row["componentName"]: row
+        for row in await db.query_raw(LATEST_SNAPSHOTS_QUERY, day.isoformat())
+    }
+
+    created, updated = [], []
+    for name, rollup in rollups.items():
+        if not rollup.found:
+            continue
+        previous = latest.get(name)
+        if previous is None:
+            created.append({"componentName": name, "day": day, "materialCost": rollup.material, "laborCost": rollup.labor})
+            continue
+        if (abs(previous["materialCost"] - rollup.material) <= SNAPSHOT_TOLERANCE
+                and abs(previous["laborCost"] - rollup.labor) <= SNAPSHOT_TOLERANCE):
+            continue
+        if previous["is_today"]:
+            # Re-run on the same day: today's point is replaced, not duplicated
+            updated.append((name, rollup))
+        else:
+            created.append({"componentName": name, "day": day, "materialCost": rollup.material, "laborCost": rollup.labor})
+
+    async with db.tx() as transaction:
+        for start in range(0, len(created), SNAPSHOT_CHUNK_SIZE):
+            await transaction.costsnapshot.create_many(data=created[start:start + SNAPSHOT_CHUNK_SIZE])
+        for name, rollup in updated:
+            await transaction.costsnapshot.update(
+                where={"componentName_day": {"componentName": name, "day": day}},
+                data={"materialCost": rollup.material, "laborCost": rollup.labor}
+            )
+
+    return len(created) + len(updated)
+
+
+async def get_cost_history(
+    component_name: str,
+    db: Prisma,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+) -> list:
+    """
+    The snapshot series of one component between start and end. The last
+    snapshot before start is included so the series has a value at start.
+    """
+    day_filter = {}
+    if start is not None:
+        day_filter["gte"] = start
+    if end is not None:
+        day_filter["lte"] = end
+
+    where = {"componentName": component_name}
+    if day_filter:
+        where["day"] = day_filter
+    snapshots = await db.costsnapshot.find_many(where=where, order={"day": "asc"})
+
+    if start is not None:
+        previous = await db.costsnapshot.find_first(
+            where={"componentName": component_name, "day": {"lt": start}},
+            order={"day": "desc"}
+        )
+        if previous:
+            snapshots.insert(0, previous)
+
+    return [
+        {
+            "date": snapshot.day.date().isoformat(),
+            "material_cost": snapshot.materialCost,
+            "labor_cost": snapshot.laborCost,
+            "total_cost": snapshot.materialCost + snapshot.laborCost,
+        }
+        for snapshot in snapshots
+    ]
+
+
+async def run_daily_snapshots(db: Prisma):
+    """Take a snapshot now and then once per UTC day."""
+    while True:
+        try:
+            written = await take_cost_snapshot(db)
+            print(f"📈 Cost snapshot taken ({written} components changed)")
+        except Exception as e:
+            print(f"❌ Cost snapshot failed: {str(e)}")
+
+        # Wake up shortly after the next UTC midnight
+        now = datetime.utcnow()
+        await asyncio.sleep((snapshot_day(now) + timedelta(days=1) - now).total_seconds() + 60)
+
+
+def start_snapshot_job(db: Prisma):
+    global _snapshot_task
+    if _snapshot_task is None or _snapshot_task.done():
+        _snapshot_task = asyncio.create_task(run_daily_snapshots(db))
+
+
+async def stop_snapshot_job():
+    global _snapshot_task
+    if _snapshot_task is not None:
+        _snapshot_task.cancel()
+        try:
+            await _snapshot_task
+        except asyncio.CancelledError:
+            pass
+        _snapshot_task = None
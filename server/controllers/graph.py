@@ -1,20 +1,172 @@
-from typing import List, Dict, Any
+import hashlib
+import json
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 from fastapi import APIRouter, Depends, HTTPException, Query
 from prisma import Prisma
 
 from .auth.auth import get_current_user
 from .auth.models import User
 from .database import get_db
-from .tree import build_tree_recursive
-from models import GraphData, Node, NodeData, Edge
+from .bom_index import bom_index
+from .tree import build_bom_dag, build_tree_recursive
+from models import GraphData, GraphFormat, Node, NodeData, Edge, TreeNode
 
 router = APIRouter(prefix="/graph", tags=["graph"])
 
+async def _dag_to_graph(topName: str, db: Prisma) -> dict:
+    """Graph with one node per component; shared sub-assemblies are drawn once."""
+    dag = await build_bom_dag(topName, db)
+    
+    nodes = [
+        {
+            "id": name,
+            "data": {
+                "label": name
+            }
+        }
+        for name in dag.nodes
+    ]
+    
+    # Same post-processing as the tree graph: drop edges from root with amount 0
+    edges = [
+        {
+            "id": f"{edge.source}_{edge.target}",
+            "source": edge.source,
+            "target": edge.target,
+            "type": "smoothstep",
+            "animated": True,
+            "label": float(edge.amount)
+        }
+        for edge in dag.edges
+        if not (edge.source == topName and edge.amount == 0.0)
+    ]
+    
+    return {
+        "nodes": nodes,
+        "edges": edges
+    }
+
+def _tree_to_compact_graph(tree: TreeNode) -> Tuple[dict, List[str]]:
+    """
+    Compact graph encoding of the expanded tree, with the path of every node.
+    
+    Node ids are positions in a pre-order walk of the tree; nodes[id] is an
+    index into the label table and edges are [source id, target id, amount].
+    Root children whose amount-0 edge is dropped hang off the root (id 0).
+    version is a hash of the encoding: ids are only meaningful together with
+    it, and writes that use ids must send it back.
+    """
+    labels = []
+    label_ids = {}
+    nodes = []
+    edges = []
+    paths = []
+    
+    stack = [(tree, None, [])]
+    while stack:
+        node, parent_id, parent_path = stack.pop()
+        node_id = len(nodes)
+        path = parent_path + [node.name]
+        paths.append("/".join(path))
+        
+        if node.name not in label_ids:
+            label_ids[node.name] = len(labels)
+            labels.append(node.name)
+        nodes.append(label_ids[node.name])
+        
+        # Same post-processing as the tree graph: drop edges from root with amount 0
+        if parent_id is not None and not (parent_id == 0 and node.amount == 0):
+            edges.append([parent_id, node_id, float(node.amount)])
+        
+        for child in reversed(node.children):
+            stack.append((child, node_id, path))
+    
+    version = hashlib.sha1(json.dumps([labels, nodes, edges]).encode()).hexdigest()[:16]
+    return {
+        "version": version,
+        "labels": labels,
+        "nodes": nodes,
+        "edges": edges
+    }, paths
+
+class CompactGraphIds:
+    """
+    Id -> path tables of the compact graphs handed out, one per root.
+    
+    A table is reused while the BOM index has not changed since it was
+    built; after any BOM change the graph is rebuilt once and its version
+    compared, so a write with ids from an outdated graph is refused instead
+    of acting on whatever node took its position.
+    """
+    
+    def __init__(self, max_roots: int = 256):
+        self.max_roots = max_roots
+        self.entries: "OrderedDict[str, Tuple[str, int, List[str]]]" = OrderedDict()
+    
+    def store(self, root: str, version: str, revision: int, paths: List[str]):
+        self.entries[root] = (version, revision, paths)
+        self.entries.move_to_end(root)
+        while len(self.entries) > self.max_roots:
+            self.entries.popitem(last=False)
+    
+    def get(self, root: str) -> Optional[Tuple[str, List[str]]]:
+        entry = self.entries.get(root)
+        if entry is None or not bom_index.loaded or entry[1] != bom_index.revision:
+            return None
+        self.entries.move_to_end(root)
+        return entry[0], entry[2]
+
+# Global compact graph id tables
+compact_graph_ids = CompactGraphIds()
+
+async def build_compact_graph(topName: str, db: Prisma) -> Tuple[dict, List[str]]:
+    revision = bom_index.revision
+    tree = await build_tree_recursive(topName, db)
+    graph, paths = _tree_to_compact_graph(tree)
+    compact_graph_ids.store(topName, graph["version"], revision, paths)
+    return graph, paths
+
+async def decode_graph_nodes(topName: str, node_ids: List[int], version: Optional[str], db: Prisma) -> Dict[int, str]:
+    """
+    Map compact graph node ids for topName back to slash-joined node paths.
+    version must be the one the ids were handed out with; 409 if the graph
+    has changed since.
+    """
+    if not version:
+        raise HTTPException(
+            status_code=400,
+            detail="graphVersion is required when relationships are given as graph node ids"
+        )
+    
+    entry = compact_graph_ids.get(topName)
+    if entry is None:
+        graph, paths = await build_compact_graph(topName, db)
+        entry = (graph["version"], paths)
+    current_version, paths = entry
+    
+    if current_version != version:
+        raise HTTPException(
+            status_code=409,
+            detail=f"The graph of '{topName}' has changed since it was loaded; reload it and retry"
+        )
+    
+    missing = [node_id for node_id in node_ids if not 0 <= node_id < len(paths)]
+    if missing:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown graph node id(s) for '{topName}': {sorted(missing)}"
+        )
+    
+    return {node_id: paths[node_id] for node_id in node_ids}
+
 @router.get("/", response_model=dict)
 async def get_graph(
     topName: str = Query(...),
     db: Prisma = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    format: GraphFormat = Query(GraphFormat.tree, description="'tree' for one node per path, 'dag' for one node per component, 'compact' for integer node ids"),
+    depth: Optional[int] = Query(None, ge=1, description="Only expand this many levels (tree format); nodes at the cutoff carry childCount")
 ):
     try:
         component = await db.components.find_first(where={"componentName": topName})
@@ -24,7 +176,14 @@ async def get_graph(
                 detail=f"Component '{topName}' not found"
             )
         
-        tree = await build_tree_recursive(topName, db)
+        if format == GraphFormat.dag:
+            return await _dag_to_graph(topName, db)
+        
+        if format == GraphFormat.compact:
+            graph, _ = await build_compact_graph(topName, db)
+            return graph
+        
+        tree = await build_tree_recursive(topName, db, max_depth=depth)
         
         nodes = []
         edges = []
@@ -36,11 +195,15 @@ async def get_graph(
             if current_path not in visited_components:
                 visited_components.add(current_path)
                 
+                data = {
+                    "label": node.name
+                }
+                if node.childCount:
+                    data["childCount"] = node.childCount
+                
                 nodes.append({
                     "id": current_path,
-                    "data": {
-                        "label": node.name
-                    }
+                    "data": data
                 })
             
             for child in node.children:
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from fastapi import HTTPException
+from prisma import Prisma
+
+from config import IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL_HOURS
+
+# Expired keys are purged from the table at most this often
+PURGE_INTERVAL = timedelta(hours=1)
+
+
+def header_key(username: str, idempotency_key: Optional[str]) -> Optional[str]:
+    """Store key of an Idempotency-Key header, in its own namespace apart from batch scan keys."""
+    return f"{username}:header:{idempotency_key}" if idempotency_key else None
+
+
+def request_fingerprint(method: str, path: str, params: dict) -> str:
+    """Hash of what a request asks for; a key is only valid for the request it was first sent with."""
+    payload = json.dumps([method.upper(), path, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _check_fingerprint(stored: Optional[str], fingerprint: str):
+    if stored != fingerprint:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency-Key was already used for a different request"
+        )
+
+
+class IdempotencyStore:
+    """
+    Responses of requests sent with an Idempotency-Key header.
+
+    A retry with a key that was already answered gets the stored response
+    back instead of being applied again. Recent keys are answered from an
+    in-memory LRU, older ones from the IdempotencyKey table; a retry that
+    arrives while the first request is still running waits for its result.
+    Each key is stored with a fingerprint of its request, and reusing it for
+    a different one is refused with 422. Keys expire after
+    IDEMPOTENCY_TTL_HOURS.
+    """
+
+    def __init__(self, max_entries: int, ttl: timedelta):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[datetime, Optional[str], dict]]" = OrderedDict()
+        self.in_flight: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self.last_purge = datetime.min
+
+    def _remember(self, key: str, expires_at: datetime, fingerprint: Optional[str], response: dict):
+        self.entries[key] = (expires_at, fingerprint, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _cached(self, key: str, fingerprint: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, stored_fingerprint, response = entry
+        if expires_at <= datetime.utcnow():
+            del self.entries[key]
+            return None
+        _check_fingerprint(stored_fingerprint, fingerprint)
+        self.entries.move_to_end(key)
+        return response
+
+    async def _stored(self, key: str, fingerprint: str, db: Prisma) -> Optional[dict]:
+        row = await db.idempotencykey.find_first(
+            where={"key": key, "expiresAt": {"gt": datetime.utcnow()}}
+        )
+        if row is None:
+            return None
+        _check_fingerprint(row.fingerprint, fingerprint)
+        response = json.loads(row.response)
+        self._remember(key, row.expiresAt.replace(tzinfo=None), row.fingerprint, response)
+        return response
+
+    async def _store(self, key: str, fingerprint: str, response: dict, db: Prisma):
+        now = datetime.utcnow()
+        expires_at = now + self.ttl
+        self._remember(key, expires_at, fingerprint, response)
+        stored = {"response": json.dumps(response), "fingerprint": fingerprint, "expiresAt": expires_at}
+        await db.idempotencykey.upsert(
+            where={"key": key},
+            data={
+                "create": {"key": key, **stored},
+                "update": stored,
+            }
+        )
+        if now - self.last_purge > PURGE_INTERVAL:
+            self.last_purge = now
+            await db.idempotencykey.delete_many(where={"expiresAt": {"lte": now}})
+
+    async def run(
+        self,
+        key: Optional[str],
+        db: Prisma,
+        action: Callable[[], Awaitable[dict]],
+        fingerprint: str = None
+    ) -> dict:
+        """
+        Run action once per key and return its JSON-ready response.
+        fingerprint identifies the request (see request_fingerprint).
+        """
+        if not key:
+            return await action()
+
+        response = self._cached(key, fingerprint)
+        if response is not None:
+            return response
+
+        if key in self.in_flight:
+            running_fingerprint, running = self.in_flight[key]
+            _check_fingerprint(running_fingerprint, fingerprint)
+            return await asyncio.shield(running)
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = (fingerprint, future)
+        try:
+            response = await self._stored(key, fingerprint, db)
+            if response is None:
+                response = await action()
+                try:
+                    await self._store(key, fingerprint, response, db)
+                except Exception as e:
+                    # The change is applied; still answer it, the LRU covers quick retries
+                    print(f"❌ Could not store idempotency key: {str(e)}")
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            # Failed requests are not remembered; the client may retry them
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved when nobody else is waiting
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            del self.in_flight[key]
+
+
+# Global idempotency store instance
+idempotency_store = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE, timedelta(hours=IDEMPOTENCY_TTL_HOURS))
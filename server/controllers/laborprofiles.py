@@ -2,13 +2,22 @@ from fastapi import APIRouter, Depends, HTTPException, status, Query
 from prisma import Prisma
 from datetime import datetime
 from typing import List
-from models import LaborProfile, LaborProfileCreate, LaborProfileUpdate
+from models import ChangeEntity, LaborProfile, LaborProfileCreate, LaborProfileUpdate
 from .database import get_db
 from .auth.auth import get_current_user
+from .rollup import rollup_cache
+from .sync import append_changes, change
 from models import User
 
 router = APIRouter(prefix="/labor-profiles", tags=["labor-profiles"])
 
+async def _profile_stage_components(profile_id: str, db: Prisma) -> List[str]:
+    """Components that have at least one production stage using the profile"""
+    stages = await db.productionstage.find_many(
+        where={"laborProfileId": profile_id}
+    )
+    return list({stage.componentName for stage in stages})
+
 @router.get("/", response_model=List[LaborProfile])
 async def get_all_labor_profiles(
     db: Prisma = Depends(get_db),
@@ -139,6 +148,10 @@ async def update_labor_profile(
             where={"id": profile_id},
             data=update_data
         )
+        
+        if profile_data.hourlyRate is not None and profile_data.hourlyRate != existing_profile.hourlyRate:
+            # Only the assemblies whose labor cost uses this rate are affected
+            rollup_cache.invalidate(*await _profile_stage_components(profile_id, db))
         return profile
     except HTTPException:
         raise
@@ -166,9 +179,16 @@ async def delete_labor_profile(
                 detail=f"Labor profile '{profile_id}' not found"
             )
         
-        await db.laborprofile.delete(
-            where={"id": profile_id}
-        )
+        stage_components = await _profile_stage_components(profile_id, db)
+        async with db.tx() as transaction:
+            await transaction.laborprofile.delete(
+                where={"id": profile_id}
+            )
+            # Stages keep their duration but lose the rate (onDelete: SetNull)
+            await append_changes(transaction, *[
+                change(ChangeEntity.stage, component_name) for component_name in stage_components
+            ])
+        rollup_cache.invalidate(*stage_components)
         return None
     except HTTPException:
         raise
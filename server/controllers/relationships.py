@@ -1,14 +1,50 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from fastapi import APIRouter, Depends, HTTPException, Query
 from prisma import Prisma
 
 from .auth.auth import get_current_user
 from .auth.models import User
 from .database import get_db
-from models import Relationship, RelationshipCreate, RelationshipRequest
+from .bom_index import bom_index, ensure_no_cycle
+from .bom_closure import edge_transaction, sync_edge_closure
+from .graph import decode_graph_nodes
+from .rollup import rollup_cache
+from .sync import append_changes, change
+from models import ChangeEntity, Relationship, RelationshipCreate, RelationshipRequest
 
 router = APIRouter(prefix="/relationships", tags=["relationships"])
 
+async def _resolve_node_refs(
+    root: Optional[str],
+    top_component: Optional[str],
+    sub_component: Optional[str],
+    top_node_id: Optional[int],
+    sub_node_id: Optional[int],
+    graph_version: Optional[str],
+    db: Prisma
+) -> Tuple[str, str]:
+    """Turn compact graph node ids into node paths; names and paths pass through unchanged."""
+    node_ids = [node_id for node_id in (top_node_id, sub_node_id) if node_id is not None]
+    if node_ids:
+        if not root:
+            raise HTTPException(
+                status_code=400,
+                detail="root is required when relationships are given as graph node ids"
+            )
+        paths = await decode_graph_nodes(root, node_ids, graph_version, db)
+        if top_node_id is not None:
+            top_component = paths[top_node_id]
+        if sub_node_id is not None:
+            sub_component = paths[sub_node_id]
+    
+    if not top_component or not sub_component:
+        raise HTTPException(
+            status_code=400,
+            detail="Both the top and sub component are required, by name, path or graph node id"
+        )
+    
+    return top_component, sub_component
+
 @router.get("/", response_model=Relationship)
 async def get_relationship(
     topComponent: str = Query(...),
@@ -38,61 +74,88 @@ async def create_relationship(
     current_user: User = Depends(get_current_user)
 ):
     try:
-        source_component = relationship_data.topComponent.split('/')[-1]
-        target_component = relationship_data.subComponent.split('/')[-1]
-
-        # First check if the relationship already exists
-        existing = await db.relationships.find_first(
-            where={
-                "topComponent": source_component,
-                "subComponent": target_component
-            }
+        top_ref, sub_ref = await _resolve_node_refs(
+            relationship_data.root,
+            relationship_data.topComponent,
+            relationship_data.subComponent,
+            relationship_data.topNodeId,
+            relationship_data.subNodeId,
+            relationship_data.graphVersion,
+            db
         )
+        source_component = top_ref.split('/')[-1]
+        target_component = sub_ref.split('/')[-1]
 
-        if existing:
-            updated = await db.relationships.update(
+        severed_root = False
+        changes = []
+        async with edge_transaction(db) as transaction:
+            await ensure_no_cycle(transaction, source_component, target_component)
+
+            # First check if the relationship already exists
+            existing = await transaction.relationships.find_first(
                 where={
-                    "topComponent_subComponent": {
-                        "topComponent": source_component,
-                        "subComponent": target_component
-                    }
-                },
-                data={"amount": relationship_data.amount}
+                    "topComponent": source_component,
+                    "subComponent": target_component
+                }
             )
 
-            return updated
+            if existing:
+                result = await transaction.relationships.update(
+                    where={
+                        "topComponent_subComponent": {
+                            "topComponent": source_component,
+                            "subComponent": target_component
+                        }
+                    },
+                    data={"amount": relationship_data.amount}
+                )
+            else:
+                # First check if there is a relationship to the root:
+                relation_to_root = await transaction.relationships.find_first(
+                    where={
+                        "topComponent": relationship_data.root,
+                        "subComponent": target_component,
+                        "amount": 0
+                    }
+                )
 
-        # First check if there is a relationship to the root:
-        relation_to_root = await db.relationships.find_first(
-            where={
-                "topComponent": relationship_data.root,
-                "subComponent": target_component,
-                "amount": 0
-            }
-        )
+                # If there is a relationship to the root, then severe it
+                if relation_to_root:
+                    await transaction.relationships.delete(
+                        where={
+                            "topComponent_subComponent": {
+                                "topComponent": relationship_data.root,
+                                "subComponent": target_component
+                            }
+                        }
+                    )
+                    bom_index.remove_edge(relationship_data.root, target_component)
+                    await sync_edge_closure(transaction, relationship_data.root, target_component)
+                    changes.append(change(ChangeEntity.relationship, relationship_data.root, target_component, deleted=True))
+                    severed_root = True
 
-        # If there is a relationship to the root, then severe it
-        if relation_to_root:
-            await db.relationships.delete(
-                where={
-                    "topComponent_subComponent": {
-                        "topComponent": relationship_data.root,
-                        "subComponent": target_component
+                # Now, create the relationship
+                result = await transaction.relationships.create(
+                    data={
+                        "topComponent": source_component,
+                        "subComponent": target_component,
+                        "amount": relationship_data.amount
                     }
-                }
-            )
-        
-        # Now, create the relationship
-        created = await db.relationships.create(
-            data={
-                "topComponent": source_component,
-                "subComponent": target_component,
-                "amount": relationship_data.amount
-            }
-        )
+                )
+
+            bom_index.set_edge(source_component, target_component, relationship_data.amount)
+            await sync_edge_closure(transaction, source_component, target_component)
+            changes.append(change(ChangeEntity.relationship, source_component, target_component))
+            await append_changes(transaction, *changes)
 
-        return created
+        if severed_root:
+            rollup_cache.invalidate(relationship_data.root)
+        rollup_cache.invalidate(source_component)
 
+        return result
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -107,6 +170,12 @@ async def update_relationship(
     current_user: User = Depends(get_current_user)
 ):
     try:
+        if not relationship_data.topComponent or not relationship_data.subComponent:
+            raise HTTPException(
+                status_code=400,
+                detail="Both topComponent and subComponent are required"
+            )
+        
         existing = await db.relationships.find_first(
             where={
                 "topComponent": relationship_data.topComponent,
@@ -120,18 +189,29 @@ async def update_relationship(
                 detail="Relationship not found"
             )
         
-        updated = await db.relationships.update(
-            where={
-                "topComponent_subComponent": {
-                    "topComponent": relationship_data.topComponent,
-                    "subComponent": relationship_data.subComponent
-                }
-            },
-            data={"amount": relationship_data.amount}
-        )
+        async with edge_transaction(db) as transaction:
+            await ensure_no_cycle(transaction, relationship_data.topComponent, relationship_data.subComponent)
+            updated = await transaction.relationships.update(
+                where={
+                    "topComponent_subComponent": {
+                        "topComponent": relationship_data.topComponent,
+                        "subComponent": relationship_data.subComponent
+                    }
+                },
+                data={"amount": relationship_data.amount}
+            )
+            bom_index.set_edge(relationship_data.topComponent, relationship_data.subComponent, relationship_data.amount)
+            await sync_edge_closure(transaction, relationship_data.topComponent, relationship_data.subComponent)
+            await append_changes(
+                transaction,
+                change(ChangeEntity.relationship, relationship_data.topComponent, relationship_data.subComponent)
+            )
+        rollup_cache.invalidate(relationship_data.topComponent)
         
         return updated
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -140,12 +220,19 @@ async def update_relationship(
 
 @router.delete("/", response_model=dict)
 async def delete_relationship(
-    topComponent: str = Query(...),
-    subComponent: str = Query(...),
+    topComponent: Optional[str] = Query(None),
+    subComponent: Optional[str] = Query(None),
     db: Prisma = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    topNodeId: Optional[int] = Query(None, description="Compact graph node id, instead of topComponent"),
+    subNodeId: Optional[int] = Query(None, description="Compact graph node id, instead of subComponent"),
+    root: Optional[str] = Query(None, description="Graph root, required with node ids"),
+    graphVersion: Optional[str] = Query(None, description="version of the compact graph the node ids come from")
 ):
     try:
+        topComponent, subComponent = await _resolve_node_refs(
+            root, topComponent, subComponent, topNodeId, subNodeId, graphVersion, db
+        )
         root = topComponent.split('/')[0]
         topComponent = topComponent.split('/')[-1]
         subComponent = subComponent.split('/')[-1]
@@ -163,20 +250,32 @@ async def delete_relationship(
                 detail="Relationship not found"
             )
         
-        await db.relationships.delete(where={
-            "topComponent_subComponent": {
-                "topComponent": topComponent,
-                "subComponent": subComponent
-            }
-        })
+        async with edge_transaction(db) as transaction:
+            await transaction.relationships.delete(where={
+                "topComponent_subComponent": {
+                    "topComponent": topComponent,
+                    "subComponent": subComponent
+                }
+            })
+            bom_index.remove_edge(topComponent, subComponent)
+            await sync_edge_closure(transaction, topComponent, subComponent)
 
-        await db.relationships.create(
-            data={
-                "topComponent": root,
-                "subComponent": subComponent,
-                "amount": 0
-            }
-        )
+            await transaction.relationships.create(
+                data={
+                    "topComponent": root,
+                    "subComponent": subComponent,
+                    "amount": 0
+                }
+            )
+            bom_index.set_edge(root, subComponent, 0)
+            await sync_edge_closure(transaction, root, subComponent)
+            await append_changes(
+                transaction,
+                change(ChangeEntity.relationship, topComponent, subComponent, deleted=True),
+                change(ChangeEntity.relationship, root, subComponent)
+            )
+
+        rollup_cache.invalidate(topComponent, root)
         
         return {"message": "Relationship deleted successfully"}
         
@@ -0,0 +1,290 @@
+from collections import ChainMap
+from typing import Dict, Iterable, List, Mapping, MutableMapping, Optional, Set
+from prisma import Prisma
+
+from .bom_index import BomIndex, bom_index, get_bom_index
+
+
+class Rollup:
+    """
+    Per-unit figures for one component.
+
+    own_* values come from the component row itself; the rolled-up values
+    include every sub-component times its quantity, recursively.
+    """
+
+    def __init__(self, name: str, component=None):
+        self.name = name
+        self.component = component
+        self.found = component is not None
+        # Names anywhere in this subtree that have no component row
+        self.missing: Set[str] = set() if self.found else {name}
+
+        stages = (component.productionStages or []) if component else []
+        self.own_material = component.cost if component else 0.0
+        self.own_labor = sum(
+            stage.duration * stage.laborProfile.hourlyRate
+            for stage in stages
+            if stage.laborProfile
+        )
+        self.own_duration = sum(stage.duration for stage in stages)
+        self.delivery_time = (component.delivery_time or 0.0) if component else 0.0
+
+        self.material = self.own_material
+        self.labor = self.own_labor
+        self.duration = self.own_duration
+        # Manufacturing time and longest delivery as /analytics/total-duration reports them
+        self.manufacturing = 0.0
+        self.max_delivery = self.delivery_time
+        # Critical path: sub-assemblies are built in parallel, so a component is
+        # ready its own stage time after its slowest input. delivery_time is
+        # taken to be in hours like the stage durations.
+        self.lead_time = self.own_duration + self.delivery_time
+        self.critical_child: Optional["Rollup"] = None
+
+    @property
+    def total(self) -> float:
+        return self.material + self.labor
+
+    def critical_path(self) -> List["Rollup"]:
+        """This component followed by the chain of inputs that determines its lead time."""
+        path = [self]
+        while path[-1].critical_child is not None:
+            path.append(path[-1].critical_child)
+        return path
+
+
+class RollupCache:
+    """
+    Process-wide per-unit rollups, kept between requests.
+
+    An entry stays valid until the component or anything below it changes,
+    so every write path that touches cost, stages, labor rates or
+    relationships calls invalidate() with the changed component; that drops
+    the entry and every ancestor entry above it, nothing else.
+    """
+
+    def __init__(self):
+        self.entries: Dict[str, Rollup] = {}
+        # Bumped on every invalidation so a computation that started before a
+        # write cannot store results that are already stale
+        self.generation = 0
+
+    def store(self, rollups: Mapping[str, Rollup], generation: int):
+        if generation == self.generation:
+            self.entries.update(rollups)
+
+    def invalidate(self, *component_names: str):
+        self.generation += 1
+        if not bom_index.loaded:
+            # Ancestors cannot be resolved without the index
+            self.entries.clear()
+            return
+        seen = {name for name in component_names if name}
+        stack = list(seen)
+        while stack:
+            name = stack.pop()
+            self.entries.pop(name, None)
+            for top_component, _ in bom_index.get_parents(name):
+                if top_component not in seen:
+                    seen.add(top_component)
+                    stack.append(top_component)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+
+# Global rollup cache instance
+rollup_cache = RollupCache()
+
+
+def reachable_components(
+    index: BomIndex,
+    top_names: Iterable[str],
+    known: Mapping[str, Rollup] = None
+) -> Set[str]:
+    """Names at or below top_names, not descending into anything already in known."""
+    known = known or {}
+    seen = {name for name in top_names if name not in known}
+    stack = list(seen)
+    while stack:
+        for sub_component, _ in index.get_children(stack.pop()):
+            if sub_component not in seen and sub_component not in known:
+                seen.add(sub_component)
+                stack.append(sub_component)
+    return seen
+
+
+def explode_plan(
+    index: BomIndex,
+    plan: Mapping[str, float],
+    on_hand: Optional[Mapping[str, float]] = None
+) -> Dict[str, float]:
+    """
+    Gross requirement of every component needed to build plan
+    (component -> quantity), planned items included.
+
+    Demand is pushed down in topological order, so each component passes
+    its total demand to its children once however many plan lines and
+    parents share it. Amount-0 canvas links are not requirements. With
+    on_hand, stock of components below the plan is used first and only
+    the remainder is passed on to their children.
+    """
+    names = set(plan)
+    stack = list(names)
+    while stack:
+        for sub_component, amount in index.get_children(stack.pop()):
+            if amount and sub_component not in names:
+                names.add(sub_component)
+                stack.append(sub_component)
+
+    pending = {name: 0 for name in names}
+    for name in names:
+        for sub_component, amount in index.get_children(name):
+            if amount:
+                pending[sub_component] += 1
+
+    required = {name: 0.0 for name in names}
+    for name, quantity in plan.items():
+        required[name] += quantity
+
+    ready = [name for name, count in pending.items() if count == 0]
+    done = 0
+    while ready:
+        name = ready.pop()
+        done += 1
+        to_build = required[name]
+        if on_hand is not None and name not in plan:
+            to_build = max(to_build - on_hand.get(name, 0.0), 0.0)
+        for sub_component, amount in index.get_children(name):
+            if amount:
+                required[sub_component] += to_build * amount
+                pending[sub_component] -= 1
+                if pending[sub_component] == 0:
+                    ready.append(sub_component)
+
+    if done < len(names):
+        raise ValueError("The BOM below the plan contains a circular reference")
+    return required
+
+
+async def load_components(names: Iterable[str], db: Prisma, with_manuals: bool = False) -> Dict[str, object]:
+    """Fetch components with their stages and labor profiles in one batched query."""
+    include = {"productionStages": {"include": {"laborProfile": True}}}
+    if with_manuals:
+        include["manuals"] = True
+    components = await db.components.find_many(
+        where={"componentName": {"in": list(names)}},
+        include=include
+    )
+    return {component.componentName: component for component in components}
+
+
+def rollup_from_data(
+    top_names: Iterable[str],
+    index: BomIndex,
+    components: Dict[str, object],
+    rollups: Optional[MutableMapping[str, Rollup]] = None
+) -> MutableMapping[str, Rollup]:
+    """
+    Single post-order pass over the BOM below top_names. Every unique
+    component is computed once; rollups already present in the dict are
+    reused as-is.
+    """
+    rollups = {} if rollups is None else rollups
+    on_path = set()
+
+    def visit(name: str) -> Rollup:
+        if name in rollups:
+            return rollups[name]
+
+        rollup = Rollup(name, components.get(name))
+        children = index.get_children(name)
+        if not children:
+            rollups[name] = rollup
+            return rollup
+
+        on_path.add(name)
+        rollup.manufacturing = rollup.own_duration
+        rollup.max_delivery = 0.0
+        for sub_component, amount in children:
+            if sub_component in on_path:
+                # Legacy cycle: count the component itself, not its subtree again
+                child = Rollup(sub_component, components.get(sub_component))
+            else:
+                child = visit(sub_component)
+            rollup.material += child.material * amount
+            rollup.labor += child.labor * amount
+            rollup.duration += child.duration * amount
+            rollup.manufacturing += child.manufacturing * amount
+            rollup.max_delivery = max(rollup.max_delivery, child.max_delivery)
+            rollup.missing |= child.missing
+            if amount and (rollup.critical_child is None or child.lead_time > rollup.critical_child.lead_time):
+                rollup.critical_child = child
+        if rollup.critical_child is not None:
+            rollup.lead_time = rollup.own_duration + max(rollup.delivery_time, rollup.critical_child.lead_time)
+        on_path.discard(name)
+
+        rollups[name] = rollup
+        return rollup
+
+    for name in top_names:
+        visit(name)
+    return rollups
+
+
+async def compute_rollups(
+    top_names: List[str],
+    db: Prisma,
+    with_manuals: bool = False,
+    subtree: bool = False
+) -> Dict[str, Rollup]:
+    """
+    Rolled-up material, labor and duration for top_names.
+
+    Cached rollups are reused as they are; only the part of the BOM below
+    top_names that is not cached yet is loaded (one query) and computed. The
+    result holds top_names plus everything computed on the way, or every
+    component below top_names when subtree is set.
+    """
+    index = await get_bom_index(db)
+    if with_manuals:
+        # Manuals are not part of the cached component rows
+        names = reachable_components(index, top_names)
+        components = await load_components(names, db, with_manuals)
+        return dict(rollup_from_data(top_names, index, components))
+
+    generation = rollup_cache.generation
+    names = reachable_components(index, top_names, rollup_cache.entries)
+    components = await load_components(names, db) if names else {}
+
+    computed: Dict[str, Rollup] = {}
+    rollups = rollup_from_data(top_names, index, components, ChainMap(computed, rollup_cache.entries))
+    rollup_cache.store(computed, generation)
+
+    if subtree:
+        return {name: rollups[name] for name in reachable_components(index, top_names)}
+    computed.update((name, rollups[name]) for name in top_names)
+    return computed
+
+
+async def compute_catalog_rollups(db: Prisma) -> Dict[str, Rollup]:
+    """
+    Rollups for every component in one bottom-up pass over the whole BOM:
+    each component is computed once from its children's finished rollups.
+    """
+    index = await get_bom_index(db)
+    generation = rollup_cache.generation
+    components = await db.components.find_many(
+        include={"productionStages": {"include": {"laborProfile": True}}}
+    )
+    by_name = {component.componentName: component for component in components}
+    rollups = rollup_from_data(list(by_name), index, by_name)
+    rollup_cache.store(rollups, generation)
+    # Keep the catalog order rather than the post-order the pass produced
+    return {name: rollups[name] for name in by_name}
+
+
+def missing_components(rollups: Mapping[str, Rollup]) -> List[str]:
+    return sorted(set().union(*(rollup.missing for rollup in rollups.values())))
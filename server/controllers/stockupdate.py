@@ -1,10 +1,234 @@
-from datetime import datetime
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Set
 from fastapi import HTTPException
 from prisma import Prisma
 from controllers.auth.models import User
-from models import Component
+from controllers.buildable import buildable_cache
+from controllers.write_behind import WriteBehindBuffer
+from controllers.sync import append_changes, change
+from config import IDEMPOTENCY_TTL_HOURS, STOCK_COALESCE_WINDOW_MS
+from models import ChangeEntity, Component, ScanBatchItem, StockMovementSource
 
 
+# Check and write in one statement: the new amount is computed from the row
+# as the database holds it, so concurrent scans cannot overwrite each other,
+# and a change that would go negative matches no row instead of being written.
+# The previous amount (for the ledger) and the component's production stages
+# come back with it.
+STOCK_UPDATE_QUERY = """
+WITH updated AS (
+    UPDATE "Components" c
+    SET amount = CASE WHEN $2::boolean THEN $1::float8 ELSE c.amount + $1::float8 END,
+        "lastScanned" = $3::timestamp,
+        "scannedBy" = $4
+    FROM (
+        SELECT "componentName", amount AS old_amount
+        FROM "Components"
+        WHERE "componentName" = $5
+        FOR UPDATE
+    ) AS previous
+    WHERE c."componentName" = previous."componentName"
+      AND CASE WHEN $2::boolean THEN $1::float8 ELSE c.amount + $1::float8 END >= 0
+    RETURNING c.*, previous.old_amount
+)
+SELECT
+    updated.*,
+    COALESCE(
+        (SELECT json_agg(ps ORDER BY ps."order") FROM "ProductionStage" ps WHERE ps."componentName" = updated."componentName"),
+        '[]'::json
+    ) AS "productionStages"
+FROM updated
+"""
+
+
+# Consumption of the direct sub-components for $1 units of $2, one statement.
+# Amounts are clamped at 0 as stock for parts is not always tracked exactly.
+CONSUME_QUERY = """
+UPDATE "Components" c
+SET amount = GREATEST(src.old_amount - src.per_unit * $1::float8, 0)
+FROM (
+    SELECT sub."componentName", sub.amount AS old_amount, r.amount AS per_unit
+    FROM "Relationships" r
+    JOIN "Components" sub ON sub."componentName" = r."subComponent"
+    WHERE r."topComponent" = $2 AND r.amount <> 0
+    FOR UPDATE OF sub
+) AS src
+WHERE c."componentName" = src."componentName"
+RETURNING c."componentName", src.old_amount, c.amount AS new_amount
+"""
+
+# Same, for the leaf parts of the whole BOM below $2, with their per-unit
+# quantities taken from the flattened BomClosure table.
+CASCADE_CONSUME_QUERY = """
+UPDATE "Components" c
+SET amount = GREATEST(src.old_amount - src.per_unit * $1::float8, 0)
+FROM (
+    SELECT leaf."componentName", leaf.amount AS old_amount, bc."quantityPer" AS per_unit
+    FROM "BomClosure" bc
+    JOIN "Components" leaf ON leaf."componentName" = bc.descendant
+    WHERE bc.ancestor = $2
+      AND bc."quantityPer" > 0
+      AND NOT EXISTS (
+          SELECT 1 FROM "Relationships" r
+          WHERE r."topComponent" = bc.descendant AND r.amount > 0
+      )
+    FOR UPDATE OF leaf
+) AS src
+WHERE c."componentName" = src."componentName"
+RETURNING c."componentName", src.old_amount, c.amount AS new_amount
+"""
+
+
+# Statements for /components/scan-batch; names and rows travel as one JSON parameter
+BATCH_CHILDREN_QUERY = """
+SELECT "topComponent", "subComponent", amount
+FROM "Relationships"
+WHERE "topComponent" IN (SELECT json_array_elements_text($1::json)) AND amount <> 0
+"""
+
+BATCH_LOCK_QUERY = """
+SELECT "componentName", amount
+FROM "Components"
+WHERE "componentName" IN (SELECT json_array_elements_text($1::json))
+ORDER BY "componentName"
+FOR UPDATE
+"""
+
+# Replayed offline scans can be older than the last one stored; lastScanned
+# and scannedBy only move forward (GREATEST skips the NULLs of sub-components)
+BATCH_UPDATE_QUERY = """
+UPDATE "Components" c
+SET amount = v.amount,
+    "lastScanned" = GREATEST(v."lastScanned", c."lastScanned"),
+    "scannedBy" = CASE WHEN v."lastScanned" > c."lastScanned" THEN v."scannedBy" ELSE c."scannedBy" END
+FROM json_to_recordset($1::json) AS v("componentName" text, amount float8, "lastScanned" timestamp, "scannedBy" text)
+WHERE c."componentName" = v."componentName"
+"""
+
+
+# Every stock movement is appended to ComponentHistory off the request path
+stock_ledger = WriteBehindBuffer("componenthistory")
+
+
+def record_movement(
+    component_name: str,
+    amount: float,
+    delta: float,
+    username: str,
+    source: StockMovementSource,
+    scanned: datetime = None
+):
+    """Queue one ledger row; username is the authenticated user who made the change."""
+    stock_ledger.add({
+        "componentName": component_name,
+        "amount": amount,
+        "delta": delta,
+        "source": source.value,
+        "scanned": scanned or datetime.utcnow(),
+        "scannedBy": username,
+    })
+
+
+# Write-back for coalesced scans, returning the rows with their stages like STOCK_UPDATE_QUERY
+COALESCED_UPDATE_QUERY = """
+WITH updated AS (
+    UPDATE "Components" c
+    SET amount = v.amount,
+        "lastScanned" = COALESCE(v."lastScanned", c."lastScanned"),
+        "scannedBy" = COALESCE(v."scannedBy", c."scannedBy")
+    FROM json_to_recordset($1::json) AS v("componentName" text, amount float8, "lastScanned" timestamp, "scannedBy" text)
+    WHERE c."componentName" = v."componentName"
+    RETURNING c.*
+)
+SELECT
+    updated.*,
+    COALESCE(
+        (SELECT json_agg(ps ORDER BY ps."order") FROM "ProductionStage" ps WHERE ps."componentName" = updated."componentName"),
+        '[]'::json
+    ) AS "productionStages"
+FROM updated
+"""
+
+
+def _component_from_row(row: dict) -> Component:
+    stages = row["productionStages"]
+    if isinstance(stages, str):
+        stages = json.loads(stages)
+    return Component(**{**row, "productionStages": stages})
+
+
+async def _write_stock_change(
+    db: Prisma,
+    component_name: str,
+    amount: float,
+    absolute: bool,
+    scannedBy: str,
+    cascade: bool,
+    source: StockMovementSource,
+    username: str
+) -> Component:
+    """One stock change with its consumption in one transaction, then the ledger."""
+    scanned = datetime.utcnow()
+    consumed = []
+    async with db.tx() as transaction:
+        # Update the current amount for the component
+        row = await transaction.query_first(
+            STOCK_UPDATE_QUERY,
+            amount,
+            absolute,
+            scanned.isoformat(),
+            scannedBy,
+            component_name
+        )
+        
+        # If an assembly is increased, decrease the subcomponents that were used to create it,
+        # in the same transaction so the parent is never booked in without its consumption
+        if row and not absolute and amount > 0:
+            consumed = await transaction.query_raw(
+                CASCADE_CONSUME_QUERY if cascade else CONSUME_QUERY,
+                amount,
+                component_name
+            )
+        
+        # Built before the commit: once the change is written, nothing may fail the request
+        updated_component = _component_from_row(row) if row else None
+        
+        if row:
+            changed = [component_name] + [sub["componentName"] for sub in consumed if sub["new_amount"] != sub["old_amount"]]
+            await append_changes(transaction, *[change(ChangeEntity.component, name) for name in changed])
+    
+    if not row:
+        # No row matched: either the component is missing or the stock is too low
+        component = await db.components.find_unique(
+            where={"componentName": component_name}
+        )
+        if not component:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Component '{component_name}' not found"
+            )
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Insufficient stock. Current: {component.amount}, Requested change: {amount}"
+        )
+    
+    record_movement(component_name, row["amount"], row["amount"] - row["old_amount"], username, source, scanned)
+    for sub in consumed:
+        if sub["new_amount"] != sub["old_amount"]:
+            record_movement(
+                sub["componentName"],
+                sub["new_amount"],
+                sub["new_amount"] - sub["old_amount"],
+                username,
+                StockMovementSource.assembly_consumption,
+                scanned
+            )
+
+    buildable_cache.invalidate()
+    
+    return updated_component
 
 
 async def update_component_stock_logic(
@@ -13,96 +237,352 @@ async def update_component_stock_logic(
     absolute: bool = False,
     scannedBy: str = "",
     db: Prisma = None,
-    current_user: User = None
+    current_user: User = None,
+    cascade: bool = False,
+    source: StockMovementSource = StockMovementSource.scan
 ) -> Component:
+    """
+    Change the stock of one component. A positive relative change books in
+    that many units and consumes the direct sub-components they are built
+    from (clamped at 0); with cascade, the leaf parts of the whole BOM are
+    consumed instead, as if every sub-assembly was built along the way.
+    """
 
     try:
         # Validate input
         if not component_name or not component_name.strip():
             raise HTTPException(status_code=400, detail="Component name cannot be empty")
         
-        component = await db.components.find_unique(
-            where={"componentName": component_name}
-        )
-        
-        if not component:
+        if absolute and amount < 0:
             raise HTTPException(
-                status_code=404,
-                detail=f"Component '{component_name}' not found"
+                status_code=400, 
+                detail=f"Cannot set negative stock amount: {amount}"
             )
         
-        # Calculate the current amount
-        new_amount = amount if absolute else component.amount + amount
+        # The ledger records who is logged in, not the free-text scannedBy of the request
+        username = current_user.username if current_user else scannedBy
 
-        # Validate new amount
-        if new_amount < 0:
-            if absolute:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Cannot set negative stock amount: {new_amount}"
-                )
-            else:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Insufficient stock. Current: {component.amount}, Requested change: {amount}"
-                )
+        if not absolute and not cascade and stock_coalescer.enabled:
+            return await stock_coalescer.submit(db, component_name, amount, scannedBy, source, username)
 
-        # Update the current amount for the component
-        updated_component = await db.components.update(
-            where={"componentName": component_name},
-            data={
-                "amount": new_amount,
-                "lastScanned": datetime.utcnow(),
-                "scannedBy": scannedBy
-            },
-            include={"productionStages": True}
+        return await _write_stock_change(db, component_name, amount, absolute, scannedBy, cascade, source, username)
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Could not update component stock: {str(e)}"
         )
 
-        # If an assembly is increased, decrease the subcomponents that were used to create it:
+
+def _utc_naive(moment: datetime = None) -> datetime:
+    """Device timestamps may carry an offset; the column stores naive UTC."""
+    if moment is None:
+        return datetime.utcnow()
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _scan_key(username: str, client_id: str) -> str:
+    return f"{username}:scan:{client_id}"
+
+
+class StockSnapshot:
+    """
+    Stock of the rows a batch of changes touches, locked and read once in
+    the batch's transaction. Changes are validated and applied in memory,
+    one after the other, the same way update_component_stock_logic makes
+    them; the final amounts are then written back with a single UPDATE.
+    """
+
+    def __init__(self, stock: Dict[str, float], children: Dict[str, list]):
+        self.stock = stock
+        self.original = dict(stock)
+        self.children = children
+
+    @classmethod
+    async def lock(cls, transaction, names: Set[str], booked_in: Set[str]) -> "StockSnapshot":
+        """Lock the named rows and the direct sub-components of those booked in."""
+        names = set(names)
+        children: Dict[str, list] = {}
+        if booked_in:
+            for row in await transaction.query_raw(BATCH_CHILDREN_QUERY, json.dumps(sorted(booked_in))):
+                children.setdefault(row["topComponent"], []).append((row["subComponent"], row["amount"]))
+                names.add(row["subComponent"])
+        
+        rows = await transaction.query_raw(BATCH_LOCK_QUERY, json.dumps(sorted(names)))
+        return cls({row["componentName"]: row["amount"] for row in rows}, children)
+
+    def apply(self, component_name: str, amount: float, absolute: bool, source: StockMovementSource) -> List[tuple]:
+        """
+        Apply one change; a positive relative change consumes the direct
+        sub-components (clamped at 0). Raises the HTTPException the
+        one-statement path would and leaves stock untouched in that case.
+        Returns the (componentName, amount, delta, source) ledger movements.
+        """
+        if component_name not in self.stock:
+            raise HTTPException(status_code=404, detail=f"Component '{component_name}' not found")
+        
+        current = self.stock[component_name]
+        if absolute:
+            if amount < 0:
+                raise HTTPException(status_code=400, detail=f"Cannot set negative stock amount: {amount}")
+            new_amount = amount
+        else:
+            new_amount = current + amount
+            if new_amount < 0:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Insufficient stock. Current: {current}, Requested change: {amount}"
+                )
+        
+        self.stock[component_name] = new_amount
+        movements = [(component_name, new_amount, new_amount - current, source)]
         if not absolute and amount > 0:
-            # Retrieve all the subcomponents for the component
-            subcomponents = await db.relationships.find_many(
-                where={"topComponent": component_name}
+            for sub_component, per_unit in self.children.get(component_name, []):
+                if sub_component in self.stock:
+                    previous = self.stock[sub_component]
+                    self.stock[sub_component] = max(previous - per_unit * amount, 0)
+                    if self.stock[sub_component] != previous:
+                        movements.append((
+                            sub_component, self.stock[sub_component], self.stock[sub_component] - previous,
+                            StockMovementSource.assembly_consumption
+                        ))
+        return movements
+
+    def updates(self, scans: Dict[str, tuple]) -> List[dict]:
+        """
+        Rows to write back: every changed amount, plus the (lastScanned,
+        scannedBy) of scanned components. Consumed sub-components keep
+        their last scan.
+        """
+        updates = []
+        for name, amount in self.stock.items():
+            scan = scans.get(name)
+            if amount == self.original[name] and scan is None:
+                continue
+            updates.append({
+                "componentName": name,
+                "amount": amount,
+                "lastScanned": scan[0].isoformat() if scan else None,
+                "scannedBy": scan[1] if scan else None,
+            })
+        return updates
+
+
+async def apply_scan_batch(scans: List[ScanBatchItem], db: Prisma, username: str) -> List[dict]:
+    """
+    Apply queued scans in order inside one transaction.
+
+    The affected rows are locked and read once, every scan is validated and
+    applied against that snapshot in memory (a rejected scan leaves stock
+    untouched and later scans see the result of the earlier ones), and all
+    final amounts are written back with a single UPDATE.
+
+    The clientId of every applied scan is kept in the IdempotencyKey table,
+    so a retried batch answers scans that were already applied with their
+    first result instead of applying them again.
+    """
+    names = {scan.componentName for scan in scans}
+    booked_in = {scan.componentName for scan in scans if not scan.absolute and scan.amount > 0}
+    results = []
+    movements = []
+    
+    async with db.tx() as transaction:
+        snapshot = await StockSnapshot.lock(transaction, names, booked_in)
+        
+        # Read after the row locks, so a concurrent retry of the same batch sees our keys
+        now = datetime.utcnow()
+        keys = {scan.clientId: _scan_key(username, scan.clientId) for scan in scans}
+        seen = {
+            row.key: json.loads(row.response)
+            for row in await transaction.idempotencykey.find_many(
+                where={"key": {"in": list(set(keys.values()))}, "expiresAt": {"gt": now}}
+            )
+        }
+        
+        scanned: Dict[str, ScanBatchItem] = {}
+        applied_keys = []
+        for scan in scans:
+            key = keys[scan.clientId]
+            if key in seen:
+                results.append(seen[key])
+                continue
+            result = {"clientId": scan.clientId, "componentName": scan.componentName}
+            try:
+                applied = snapshot.apply(scan.componentName, scan.amount, scan.absolute, StockMovementSource.batch)
+            except HTTPException as e:
+                results.append({**result, "status": "rejected", "detail": e.detail})
+                continue
+            movements += [(scan, *movement) for movement in applied]
+            result.update(status="applied", amount=snapshot.stock[scan.componentName])
+            previous = scanned.get(scan.componentName)
+            if previous is None or _utc_naive(scan.scannedAt) >= _utc_naive(previous.scannedAt):
+                scanned[scan.componentName] = scan
+            seen[key] = result
+            applied_keys.append({
+                "key": key,
+                "response": json.dumps(result),
+                "expiresAt": now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+            })
+            results.append(result)
+        
+        updates = snapshot.updates({
+            name: (_utc_naive(scan.scannedAt), scan.scannedBy) for name, scan in scanned.items()
+        })
+        if applied_keys:
+            # Expired keys of an earlier batch may still be there; replace them
+            await transaction.idempotencykey.delete_many(
+                where={"key": {"in": [row["key"] for row in applied_keys]}}
             )
+            await transaction.idempotencykey.create_many(data=applied_keys)
+        if updates:
+            await transaction.execute_raw(BATCH_UPDATE_QUERY, json.dumps(updates))
+            await append_changes(transaction, *[change(ChangeEntity.component, update["componentName"]) for update in updates])
+    
+    for scan, name, amount, delta, source in movements:
+        record_movement(name, amount, delta, username, source, _utc_naive(scan.scannedAt))
+    buildable_cache.invalidate()
+    return results
+
+
+class StockCoalescer:
+    """
+    Relative stock changes collected for a few milliseconds and written
+    together.
+
+    Everything that arrives within the window costs one locking read and
+    one UPDATE, instead of one read-modify-write per scan queueing on the
+    same hot rows. Callers are still validated one by one in arrival order
+    (an overdraft only fails that caller), book-ins consume their
+    sub-components before the next caller is checked, and each caller gets
+    the amount after its own change. A window with a single change goes
+    through the one-statement path.
+    """
+
+    def __init__(self, window_ms: float):
+        self.window = window_ms / 1000
+        self.pending: List[tuple] = []
+        self._flush_task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def submit(
+        self,
+        db: Prisma,
+        component_name: str,
+        delta: float,
+        scanned_by: str,
+        source: StockMovementSource,
+        username: str
+    ) -> Component:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((component_name, delta, scanned_by, source, username, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later(db))
+        return await future
 
-            # Iterate over all the subcomponents to update them in the database
-            for subcomp in subcomponents:
-                # We need the current amount for each subcomponent 
-                subcomp_data = await db.components.find_first(
-                    where={
-                        "componentName": subcomp.subComponent
-                    }
+    async def _flush_later(self, db: Prisma):
+        await asyncio.sleep(self.window)
+        batch, self.pending = self.pending, []
+        self._flush_task = None
+
+        if len(batch) == 1:
+            # Nothing to coalesce with: take the one-statement path
+            name, delta, scanned_by, source, username, future = batch[0]
+            try:
+                result = await _write_stock_change(db, name, delta, False, scanned_by, False, source, username)
+            except Exception as e:
+                result = e if isinstance(e, HTTPException) else HTTPException(
+                    status_code=400,
+                    detail=f"Could not update component stock: {str(e)}"
                 )
+            # The caller may have been cancelled while the change was written
+            if not future.done():
+                if isinstance(result, HTTPException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            return
+
+        try:
+            results, movements, scanned = await self._apply(batch, db)
+        except Exception as e:
+            # Raised before the commit, so none of the changes were written
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(HTTPException(
+                        status_code=400,
+                        detail=f"Could not update component stock: {str(e)}"
+                    ))
+            return
+
+        # Committed: from here on every caller gets its result
+        for future, result in results:
+            if future.done():
+                continue
+            if isinstance(result, HTTPException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        try:
+            for name, amount, delta, source, username in movements:
+                record_movement(name, amount, delta, username, source, scanned)
+            buildable_cache.invalidate()
+        except Exception as e:
+            print(f"❌ Could not record coalesced stock movements: {str(e)}")
 
-                if not subcomp_data:
+    async def _apply(self, batch: List[tuple], db: Prisma):
+        """
+        Validate and apply the batch in arrival order inside one transaction.
+        Book-ins consume their sub-components before the next caller is
+        checked, exactly as if the changes had been made one after the other.
+        Returns each caller's result with the ledger movements; nothing that
+        can fail is left for after the commit.
+        """
+        scanned = datetime.utcnow()
+        names = {name for name, *_ in batch}
+        booked_in = {name for name, delta, *_ in batch if delta > 0}
+        outcomes = []
+        movements = []
+        last_scanned_by: Dict[str, str] = {}
+
+        async with db.tx() as transaction:
+            snapshot = await StockSnapshot.lock(transaction, names, booked_in)
+
+            for name, delta, scanned_by, source, username, future in batch:
+                try:
+                    applied = snapshot.apply(name, delta, False, source)
+                except HTTPException as e:
+                    outcomes.append((future, e))
                     continue
+                last_scanned_by[name] = scanned_by
+                movements += [(*movement, username) for movement in applied]
+                outcomes.append((future, (name, snapshot.stock[name], scanned_by)))
 
-                # Calculate the new amount for the component
-                current_amount = subcomp_data.amount
-                relationship_amount = subcomp.amount
-                new_subcomp_amount = current_amount - relationship_amount*amount
-
-                # Warn but don't fail if subcomponent goes negative
-                if new_subcomp_amount < 0:
-                    new_subcomp_amount = 0
-
-                # Update the amount for each subcomponent
-                await db.components.update(
-                    where={
-                        "componentName": subcomp.subComponent
-                    },
-                    data={
-                        "amount": new_subcomp_amount
-                    }
-                )
+            updates = snapshot.updates({
+                name: (scanned, scanned_by) for name, scanned_by in last_scanned_by.items()
+            })
+            updated = {}
+            if updates:
+                for row in await transaction.query_raw(COALESCED_UPDATE_QUERY, json.dumps(updates)):
+                    updated[row["componentName"]] = row
+                await append_changes(transaction, *[change(ChangeEntity.component, name) for name in updated])
 
-        
-        return updated_component
-        
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Could not update component stock: {str(e)}"
-        )
+            results = []
+            for future, outcome in outcomes:
+                if isinstance(outcome, HTTPException):
+                    results.append((future, outcome))
+                    continue
+                name, amount, scanned_by = outcome
+                results.append((future, _component_from_row({**updated[name], "amount": amount, "scannedBy": scanned_by})))
+
+        return results, movements, scanned
+
+
+# Global stock coalescer instance
+stock_coalescer = StockCoalescer(STOCK_COALESCE_WINDOW_MS)
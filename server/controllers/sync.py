@@ -0,0 +1,181 @@
+from typing import Dict, List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Query
+from prisma import Prisma
+
+from .auth.auth import get_current_user
+from .auth.models import User
+from .database import get_db
+from .bom_index import BomIndex
+from models import ChangeEntity, ChangeOperation
+
+router = APIRouter(prefix="/sync", tags=["sync"])
+
+# Every row carries the id of the transaction that wrote it. A transaction
+# still running has an id at or above the oldest running one (the snapshot
+# xmin), and so does every transaction that starts later; reading only rows
+# below it and using it as the cursor never skips a late commit, without
+# serializing the writers
+SNAPSHOT_XMIN_QUERY = """
+SELECT (pg_snapshot_xmin(pg_current_snapshot())::text)::bigint AS xmin
+"""
+
+
+def change(
+    entity: ChangeEntity,
+    component_name: str,
+    sub_component: Optional[str] = None,
+    deleted: bool = False
+) -> dict:
+    """One change log row; relationships are keyed by top and sub component."""
+    return {
+        "entity": entity.value,
+        "componentName": component_name,
+        "subComponent": sub_component,
+        "op": (ChangeOperation.delete if deleted else ChangeOperation.upsert).value,
+    }
+
+
+def component_changes(index: BomIndex, component_name: str, deleted: bool = False) -> List[dict]:
+    """A component together with its stages and every edge it is on."""
+    changes = [
+        change(ChangeEntity.component, component_name, deleted=deleted),
+        change(ChangeEntity.stage, component_name, deleted=deleted),
+    ]
+    for sub_component, _ in index.get_children(component_name):
+        changes.append(change(ChangeEntity.relationship, component_name, sub_component, deleted))
+    for top_component, _ in index.get_parents(component_name):
+        changes.append(change(ChangeEntity.relationship, top_component, component_name, deleted))
+    return changes
+
+
+async def append_changes(transaction, *changes: dict):
+    """Append changes in the transaction that made them, as its last statement."""
+    if not changes:
+        return
+    await transaction.changelog.create_many(data=list(changes))
+
+
+async def record_changes(db: Prisma, *changes: dict):
+    """Append changes right after a write that did not run in a transaction."""
+    if not changes:
+        return
+    async with db.tx() as transaction:
+        await append_changes(transaction, *changes)
+
+
+async def current_cursor(db: Prisma) -> int:
+    """Transaction id below which every change has been committed."""
+    rows = await db.query_raw(SNAPSHOT_XMIN_QUERY)
+    return int(rows[0]["xmin"])
+
+
+async def read_entries(since: int, db: Prisma, limit: int) -> Tuple[list, int, bool]:
+    """
+    Change log rows of the transactions from since up to the committed
+    boundary, in transaction order, with the cursor to continue from.
+    A page never ends inside a transaction; one transaction larger than
+    limit is returned whole.
+    """
+    boundary = await current_cursor(db)
+    entries = await db.changelog.find_many(
+        where={"txid": {"gte": since, "lt": boundary}},
+        order=[{"txid": "asc"}, {"seq": "asc"}],
+        take=limit + 1
+    )
+    if len(entries) <= limit:
+        return entries, max(boundary, since), False
+
+    cursor = entries[limit].txid
+    entries = [entry for entry in entries if entry.txid < cursor]
+    if not entries:
+        entries = await db.changelog.find_many(
+            where={"txid": cursor},
+            order={"seq": "asc"}
+        )
+        cursor += 1
+    return entries, cursor, True
+
+
+async def collect_changes(since: int, db: Prisma, limit: int) -> dict:
+    """
+    Current state of everything changed after since, one row per entity.
+
+    Only the latest change of each entity counts; an entity whose latest
+    change is an upsert but that no longer exists is reported as deleted.
+    """
+    entries, cursor, has_more = await read_entries(since, db, limit)
+
+    latest: Dict[Tuple[str, str, Optional[str]], str] = {}
+    for entry in entries:
+        latest[(entry.entity, entry.componentName, entry.subComponent)] = entry.op
+
+    def keys(entity: ChangeEntity) -> Tuple[list, list]:
+        upserts, deletes = [], []
+        for (kind, component_name, sub_component), op in latest.items():
+            if kind == entity.value:
+                key = (component_name, sub_component) if entity == ChangeEntity.relationship else component_name
+                (deletes if op == ChangeOperation.delete.value else upserts).append(key)
+        return upserts, deletes
+
+    component_names, deleted_components = keys(ChangeEntity.component)
+    components = await db.components.find_many(
+        where={"componentName": {"in": component_names}}
+    ) if component_names else []
+    found = {component.componentName for component in components}
+    deleted_components += [name for name in component_names if name not in found]
+
+    relationship_pairs, deleted_relationships = keys(ChangeEntity.relationship)
+    relationships = []
+    if relationship_pairs:
+        relationships = await db.relationships.find_many(
+            where={"OR": [{"topComponent": top, "subComponent": sub} for top, sub in relationship_pairs]}
+        )
+    found = {(rel.topComponent, rel.subComponent) for rel in relationships}
+    deleted_relationships += [pair for pair in relationship_pairs if pair not in found]
+
+    # Stages are synced as the whole ordered set of one component
+    stage_owners, deleted_stage_owners = keys(ChangeEntity.stage)
+    stages: Dict[str, list] = {name: [] for name in stage_owners}
+    if stage_owners:
+        for stage in await db.productionstage.find_many(
+            where={"componentName": {"in": stage_owners}},
+            order={"order": "asc"}
+        ):
+            stages[stage.componentName].append(stage)
+
+    return {
+        "cursor": cursor,
+        "hasMore": has_more,
+        "components": components,
+        "relationships": relationships,
+        "stages": stages,
+        "deleted": {
+            "components": deleted_components,
+            "relationships": [
+                {"topComponent": top, "subComponent": sub}
+                for top, sub in deleted_relationships
+            ],
+            "stages": deleted_stage_owners,
+        },
+    }
+
+
+@router.get("/changes", response_model=dict)
+async def get_changes(
+    since: Optional[int] = Query(None, ge=0, description="Cursor from the previous sync; omit for a full resync"),
+    limit: int = Query(1000, ge=1, le=10000, description="Change log entries to read per call"),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Components, relationships and stages changed since a cursor.
+
+    Without since, nothing is returned except the current cursor: the client
+    downloads the full lists once and syncs from that cursor afterwards.
+    Follow up while hasMore is set.
+    """
+    try:
+        if since is None:
+            return {"cursor": await current_cursor(db), "fullResync": True}
+        return await collect_changes(since, db, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not load changes: {str(e)}")
@@ -1,62 +1,435 @@
-from typing import List, Optional
+import json
+from typing import AsyncIterator, Dict, List, Optional
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from prisma import Prisma
 
 from .auth.auth import get_current_user
 from .auth.models import User
 from .database import get_db
-from models import ComponentTree, TreeNode
+from .bom_index import BomIndex, get_bom_index
+from .rollup import Rollup, compute_rollups
+from config import BOM_INDEX_ENABLED
+from models import BomDag, BomDagEdge, ComponentTree, CostedTreeNode, TreeFormat, TreeNode, WhereUsedEntry
 
 router = APIRouter(prefix="/tree", tags=["tree"])
 
-async def build_tree_recursive(component_name: str, db: Prisma, visited: set = None, path: list = None) -> TreeNode:
+# Whole-BOM fetch in one round trip. Each row is one edge of the expanded tree;
+# `path` holds the component names from the root down to the sub component and
+# doubles as the cycle guard: an edge pointing back into its own path is
+# returned once (flagged is_cycle) but not expanded further. $2 optionally
+# limits the depth; child_count lets the caller mark nodes at the cutoff.
+BOM_EDGES_QUERY = """
+WITH RECURSIVE bom AS (
+    SELECT
+        r."topComponent",
+        r."subComponent",
+        r.amount,
+        1 AS depth,
+        ARRAY[r."topComponent", r."subComponent"] AS path,
+        r."subComponent" = r."topComponent" AS is_cycle
+    FROM "Relationships" r
+    WHERE r."topComponent" = $1
+    UNION ALL
+    SELECT
+        r."topComponent",
+        r."subComponent",
+        r.amount,
+        bom.depth + 1,
+        bom.path || r."subComponent",
+        r."subComponent" = ANY(bom.path)
+    FROM "Relationships" r
+    JOIN bom ON r."topComponent" = bom."subComponent"
+    WHERE NOT bom.is_cycle
+      AND ($2::int IS NULL OR bom.depth < $2::int)
+)
+SELECT
+    "topComponent",
+    "subComponent",
+    amount,
+    depth,
+    path,
+    is_cycle,
+    (SELECT COUNT(*) FROM "Relationships" c WHERE c."topComponent" = bom."subComponent")::int AS child_count
+FROM bom
+ORDER BY path
+"""
+
+# Unique edges reachable from the root. UNION (not UNION ALL) collapses
+# repeated sub-assemblies, so the result scales with unique components.
+BOM_DAG_QUERY = """
+WITH RECURSIVE reachable(name) AS (
+    SELECT $1::text
+    UNION
+    SELECT r."subComponent"
+    FROM "Relationships" r
+    JOIN reachable ON r."topComponent" = reachable.name
+)
+SELECT r."topComponent", r."subComponent", r.amount
+FROM "Relationships" r
+JOIN reachable ON r."topComponent" = reachable.name
+"""
+
+# One BOM level with the number of children of each child, for lazy expansion
+BOM_LEVEL_QUERY = """
+SELECT
+    r."subComponent",
+    r.amount,
+    (SELECT COUNT(*) FROM "Relationships" c WHERE c."topComponent" = r."subComponent")::int AS child_count
+FROM "Relationships" r
+WHERE r."topComponent" = $1
+"""
+
+async def fetch_bom_rows(component_name: str, db: Prisma, max_depth: Optional[int] = None) -> List[dict]:
+    """Fetch every edge below component_name (down to max_depth) with a single recursive query."""
+    return await db.query_raw(BOM_EDGES_QUERY, component_name, max_depth)
+
+def build_tree_from_rows(component_name: str, rows: List[dict], max_depth: Optional[int] = None) -> TreeNode:
+    """Assemble TreeNodes from the flat rows returned by fetch_bom_rows."""
+    root = TreeNode(name=component_name, amount=1, children=[])
+    nodes = {(component_name,): root}
+    
+    # Rows are ordered by path, so a parent is always seen before its children
+    for row in rows:
+        path = tuple(row["path"])
+        parent = nodes.get(path[:-1])
+        if parent is None:
+            continue
+        
+        if row["is_cycle"]:
+            print(f"Circular reference detected: {' -> '.join(path)}")
+        
+        # A cycle node carries amount 0, like the index builder returns it
+        node = TreeNode(name=row["subComponent"], amount=0 if row["is_cycle"] else row["amount"], children=[])
+        if max_depth is not None and row["depth"] >= max_depth and not row["is_cycle"] and row["child_count"]:
+            node.childCount = row["child_count"]
+        parent.children.append(node)
+        nodes[path] = node
+    
+    return root
+
+async def build_tree_recursive(component_name: str, db: Prisma, visited: set = None, path: list = None, max_depth: Optional[int] = None) -> TreeNode:
     """
     Build tree recursively, handling duplicate components correctly.
     
+    Edges are served from the in-memory BOM index, or fetched with one
+    recursive query when the index is disabled, so the whole tree is built
+    without a database round trip per node.
+    
     Args:
         component_name: The component to build tree for
         db: Database connection
         visited: Set of components in current path (for circular reference detection)
         path: Current path from root (for debugging/logging)
+        max_depth: Stop expanding below this many levels; nodes at the cutoff
+            carry their childCount so the client can expand them later
     """
+    if not BOM_INDEX_ENABLED:
+        rows = await fetch_bom_rows(component_name, db, max_depth)
+        return build_tree_from_rows(component_name, rows, max_depth)
+    
+    index = await get_bom_index(db)
+    return _build_tree_from_index(component_name, index, visited, path, max_depth)
+
+def _build_tree_from_index(component_name: str, index: BomIndex, visited: set = None, path: list = None, max_depth: Optional[int] = None) -> TreeNode:
     if visited is None:
         visited = set()
     if path is None:
         path = []
     
-    # Check for circular references in the current path only
+    # Cycles are rejected when relationships are written, so this only guards
+    # against legacy data that predates that check
     if component_name in visited:
-        # Prevent infinite loops in case of circular relationships
         print(f"Circular reference detected: {' -> '.join(path)} -> {component_name}")
         return TreeNode(name=component_name, amount=0, children=[])
     
-    # Add to current path for circular reference detection
+    if max_depth is not None and len(path) >= max_depth:
+        child_count = len(index.get_children(component_name))
+        return TreeNode(name=component_name, amount=1, children=[], childCount=child_count or None)
+    
+    # visited and path hold the current root path only; they are shared by all
+    # children and unwound on the way back up instead of copied per child
     visited.add(component_name)
     path.append(component_name)
     
-    # Get all relationships where this component is the top component
-    relationships = await db.relationships.find_many(
-        where={"topComponent": component_name}
-    )
-    
     children = []
-    for rel in relationships:
-        # For each child, create a new visited set that includes current path
-        # This allows the same component to appear in different branches
-        child_visited = visited.copy()
-        child_path = path.copy()
-        
-        child_node = await build_tree_recursive(rel.subComponent, db, child_visited, child_path)
-        child_node.amount = rel.amount
+    for sub_component, amount in index.get_children(component_name):
+        # A cycle node keeps amount 0, so forecasting reserves nothing for the circular edge
+        is_cycle = sub_component in visited
+        child_node = _build_tree_from_index(sub_component, index, visited, path, max_depth)
+        if not is_cycle:
+            child_node.amount = amount
         children.append(child_node)
     
+    visited.discard(component_name)
+    path.pop()
+    
     return TreeNode(name=component_name, amount=1, children=children)
 
+async def iter_tree_nodes(component_name: str, db: Prisma, max_depth: Optional[int] = None) -> AsyncIterator[dict]:
+    """
+    Walk the expanded tree in pre-order without materializing TreeNodes.
+    
+    Yields one dict per node with id, parent (None for the root), depth, name
+    and amount; nodes at a max_depth cutoff also carry childCount. Only the
+    current root path is held in memory when the BOM index is enabled.
+    """
+    if not BOM_INDEX_ENABLED:
+        rows = await fetch_bom_rows(component_name, db, max_depth)
+        yield {"id": 0, "parent": None, "depth": 0, "name": component_name, "amount": 1.0}
+        ids = {(component_name,): 0}
+        for node_id, row in enumerate(rows, start=1):
+            path = tuple(row["path"])
+            ids[path] = node_id
+            node = {
+                "id": node_id,
+                "parent": ids.get(path[:-1]),
+                "depth": row["depth"],
+                "name": row["subComponent"],
+                "amount": 0 if row["is_cycle"] else row["amount"]
+            }
+            if max_depth is not None and row["depth"] >= max_depth and not row["is_cycle"] and row["child_count"]:
+                node["childCount"] = row["child_count"]
+            yield node
+        return
+    
+    index = await get_bom_index(db)
+    path = []
+    on_path = set()
+    stack = [(component_name, 1.0, 0, None)]
+    next_id = 0
+    
+    while stack:
+        name, amount, depth, parent_id = stack.pop()
+        while len(path) > depth:
+            on_path.discard(path.pop())
+        
+        node_id = next_id
+        next_id += 1
+        node = {"id": node_id, "parent": parent_id, "depth": depth, "name": name, "amount": amount}
+        
+        children = index.get_children(name)
+        if name in on_path:
+            print(f"Circular reference detected: {' -> '.join(path)} -> {name}")
+            node["amount"] = 0
+        elif max_depth is not None and depth >= max_depth:
+            if children:
+                node["childCount"] = len(children)
+        else:
+            path.append(name)
+            on_path.add(name)
+            for sub_component, sub_amount in reversed(children):
+                stack.append((sub_component, sub_amount, depth + 1, node_id))
+        
+        yield node
+
+async def ndjson_stream(items: AsyncIterator[dict], chunk_size: int = 200) -> AsyncIterator[str]:
+    """Encode dicts as newline-delimited JSON, flushing every chunk_size lines."""
+    lines = []
+    async for item in items:
+        lines.append(json.dumps(item, default=str))
+        if len(lines) >= chunk_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+async def build_bom_dag(component_name: str, db: Prisma) -> BomDag:
+    """
+    Build the BOM as a shared-subtree graph: every component appears once in
+    the node table and each relationship once in the edge list, no matter how
+    many assemblies reuse it.
+    """
+    edges = []
+    if not BOM_INDEX_ENABLED:
+        rows = await db.query_raw(BOM_DAG_QUERY, component_name)
+        for row in rows:
+            edges.append(BomDagEdge(source=row["topComponent"], target=row["subComponent"], amount=row["amount"]))
+    else:
+        index = await get_bom_index(db)
+        expanded = set()
+        stack = [component_name]
+        while stack:
+            current = stack.pop()
+            if current in expanded:
+                continue
+            expanded.add(current)
+            for sub_component, amount in index.get_children(current):
+                edges.append(BomDagEdge(source=current, target=sub_component, amount=amount))
+                stack.append(sub_component)
+    
+    nodes = [component_name]
+    seen = {component_name}
+    for edge in edges:
+        if edge.target not in seen:
+            seen.add(edge.target)
+            nodes.append(edge.target)
+    
+    return BomDag(root=component_name, nodes=nodes, edges=edges)
+
+async def compute_where_used(component_name: str, db: Prisma) -> List[WhereUsedEntry]:
+    """
+    Every assembly that contains component_name, directly or transitively,
+    with the cumulative quantity needed per unit of that assembly. Read from
+    the BomClosure table in one indexed lookup. Ancestors that only reach the
+    component through amount-0 placeholder edges are left out.
+    """
+    rows = await db.bomclosure.find_many(
+        where={"descendant": component_name, "quantityPer": {"gt": 0}}
+    )
+    ancestors = {row.ancestor: (row.quantityPer, row.depth) for row in rows}
+    
+    components = await db.components.find_many(
+        where={"componentName": {"in": list(ancestors)}}
+    )
+    types = {component.componentName: component.type for component in components}
+    
+    entries = [
+        WhereUsedEntry(componentName=name, type=types.get(name), quantityPer=quantity, depth=depth)
+        for name, (quantity, depth) in ancestors.items()
+    ]
+    entries.sort(key=lambda entry: (entry.depth, entry.componentName))
+    return entries
+
+def build_costed_tree(
+    component_name: str,
+    index: BomIndex,
+    rollups: Dict[str, Rollup],
+    amount: float = 1,
+    quantity: float = 1,
+    visited: set = None
+) -> CostedTreeNode:
+    """Expand the tree from the index, annotating each node from its already computed rollup."""
+    if visited is None:
+        visited = set()
+    
+    rollup = rollups.get(component_name) or Rollup(component_name)
+    node = CostedTreeNode(
+        name=component_name,
+        amount=amount,
+        quantity=quantity,
+        ownCost=rollup.own_material,
+        ownLaborCost=rollup.own_labor,
+        materialCost=rollup.material,
+        laborCost=rollup.labor,
+        totalCost=rollup.total,
+        duration=rollup.duration,
+        children=[]
+    )
+    
+    if component_name in visited:
+        # Legacy cycle, see _build_tree_from_index
+        node.amount = 0
+        return node
+    
+    visited.add(component_name)
+    for sub_component, sub_amount in index.get_children(component_name):
+        node.children.append(
+            build_costed_tree(sub_component, index, rollups, sub_amount, quantity * sub_amount, visited)
+        )
+    visited.discard(component_name)
+    
+    return node
+
+@router.get("/costed", response_model=dict)
+async def get_costed_tree(
+    topName: str = Query(...),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """The tree together with per-node costs, replacing a /tree plus /analytics round trip."""
+    try:
+        rollups = await compute_rollups([topName], db, subtree=True)
+        if not rollups[topName].found:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Component '{topName}' not found"
+            )
+        
+        index = await get_bom_index(db)
+        tree = build_costed_tree(topName, index, rollups)
+        return {"tree": tree.dict()}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Could not build costed tree: {str(e)}"
+        )
+
+@router.get("/where-used", response_model=dict)
+async def get_where_used(
+    component: str = Query(..., description="Component to look up"),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    existing = await db.components.find_first(where={"componentName": component})
+    if not existing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Component '{component}' not found"
+        )
+    
+    try:
+        entries = await compute_where_used(component, db)
+        return {
+            "component": component,
+            "usedIn": [entry.dict() for entry in entries]
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Could not compute where-used: {str(e)}"
+        )
+
+async def expand_node(component_name: str, db: Prisma) -> List[dict]:
+    """One level below component_name, with each child's own child count."""
+    if not BOM_INDEX_ENABLED:
+        rows = await db.query_raw(BOM_LEVEL_QUERY, component_name)
+        return [
+            {"name": row["subComponent"], "amount": row["amount"], "childCount": row["child_count"]}
+            for row in rows
+        ]
+    
+    index = await get_bom_index(db)
+    return [
+        {"name": sub_component, "amount": amount, "childCount": len(index.get_children(sub_component))}
+        for sub_component, amount in index.get_children(component_name)
+    ]
+
+@router.get("/expand", response_model=dict)
+async def get_tree_level(
+    node: str = Query(..., description="Component name or graph node path to expand"),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Fetch the direct children of one node, for lazily expanding a depth-limited tree."""
+    try:
+        component_name = node.split('/')[-1]
+        children = await expand_node(component_name, db)
+        
+        for child in children:
+            child["id"] = f"{node}/{child['name']}"
+        
+        return {
+            "node": node,
+            "children": children
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Could not expand node: {str(e)}"
+        )
+
 @router.get("/", response_model=dict)
 async def get_tree(
     topName: str = Query(...),
     db: Prisma = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    format: TreeFormat = Query(TreeFormat.tree, description="'tree' for the expanded tree, 'dag' for a node table plus edge list"),
+    depth: Optional[int] = Query(None, ge=1, description="Only expand this many levels; nodes at the cutoff carry childCount"),
+    stream: bool = Query(False, description="Stream the tree as NDJSON, one node per line in pre-order")
 ):
     try:
         # Check if the component exists
@@ -67,10 +440,20 @@ async def get_tree(
                 detail=f"Component '{topName}' not found"
             )
         
+        if format == TreeFormat.dag:
+            dag = await build_bom_dag(topName, db)
+            return {"dag": dag.dict()}
+        
+        if stream:
+            return StreamingResponse(
+                ndjson_stream(iter_tree_nodes(topName, db, max_depth=depth)),
+                media_type="application/x-ndjson"
+            )
+        
         # Build the tree structure
-        tree = await build_tree_recursive(topName, db)
+        tree = await build_tree_recursive(topName, db, max_depth=depth)
         
-        return {"tree": tree.dict()}
+        return {"tree": tree.dict(exclude_none=True)}
         
     except Exception as e:
         raise HTTPException(
@@ -0,0 +1,71 @@
+import asyncio
+from typing import List, Optional
+from prisma import Prisma
+
+
+class WriteBehindBuffer:
+    """
+    Rows for an append-only table, collected in memory and inserted in
+    batches with create_many instead of one insert per request.
+
+    A background task flushes every flush_interval seconds, or as soon as
+    max_rows are waiting; stop() flushes whatever is left on shutdown. Rows
+    of a failed flush are kept for the next attempt.
+    """
+
+    def __init__(self, table: str, flush_interval: float = 1.0, max_rows: int = 500):
+        self.table = table
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.rows: List[dict] = []
+        self._db: Optional[Prisma] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def add(self, *rows: dict):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.max_rows:
+            self._wakeup.set()
+
+    async def flush(self, db: Prisma = None) -> int:
+        db = db or self._db
+        if not self.rows or db is None:
+            return 0
+        rows, self.rows = self.rows, []
+        try:
+            await getattr(db, self.table).create_many(data=rows)
+        except Exception as e:
+            # Put them back in front so the order of the ledger is kept
+            self.rows[:0] = rows
+            print(f"❌ Could not flush {len(rows)} {self.table} rows: {str(e)}")
+            return 0
+        except BaseException:
+            # Cancelled mid-flush: keep the rows for the final flush
+            self.rows[:0] = rows
+            raise
+        return len(rows)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self, db: Prisma):
+        self._db = db
+        self._stopping = False
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Let a flush in progress finish instead of cancelling it
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
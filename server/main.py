@@ -1,5 +1,6 @@
 from datetime import datetime
-from fastapi import FastAPI, APIRouter, Body, Depends, HTTPException, Query
+from fastapi import FastAPI, APIRouter, Body, Depends, Header, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
@@ -10,10 +11,10 @@ from models import ComponentCreate
 
 from config import (
     APP_TITLE, APP_VERSION, CORS_ORIGINS, CORS_CREDENTIALS, 
-    CORS_METHODS, CORS_HEADERS, HOST, PORT
+    CORS_METHODS, CORS_HEADERS, HOST, PORT, COST_SNAPSHOTS_ENABLED
 )
-from controllers.database import connect_db, disconnect_db
-from controllers import components, relationships, tree, graph, analytics, forecasting, manuals, checklists, laborprofiles, mobile_app
+from controllers.database import connect_db, disconnect_db, prisma
+from controllers import components, relationships, tree, graph, analytics, forecasting, manuals, checklists, laborprofiles, mobile_app, bom_closure, cost_snapshots, sync
 from controllers.auth import auth_routes
 
 app = FastAPI(title=APP_TITLE, version=APP_VERSION)
@@ -72,9 +73,11 @@ app.include_router(manuals.router)
 app.include_router(checklists.router)
 app.include_router(laborprofiles.router)
 app.include_router(mobile_app.router)
+app.include_router(bom_closure.router)
+app.include_router(sync.router)
 
 # Add direct compatibility routes for frontend
-from models import UserLogin, Token, Component, RelationshipCreate, Relationship, ComponentUpdate, UserCreate, CreateAppUser, ReturnUser, RelationshipRequest, ComponentName, ComponentNameOnly, User as UserModel
+from models import UserLogin, Token, Component, RelationshipCreate, Relationship, ComponentUpdate, UserCreate, CreateAppUser, ReturnUser, RelationshipRequest, ComponentName, ComponentNameOnly, GraphFormat, ScanBatchRequest, StockMovementSource, TreeFormat, User as UserModel
 from prisma import Prisma
 from controllers.database import get_db
 from controllers.auth.auth import get_current_user
@@ -92,7 +95,8 @@ from controllers.relationships import get_relationship, create_relationship, upd
 from controllers.tree import get_tree
 from controllers.graph import get_graph
 from controllers.auth.auth_routes import login, app_login, register, app_register, get_current_user_info, logout
-from controllers.stockupdate import update_component_stock_logic
+from controllers.stockupdate import apply_scan_batch, stock_ledger, update_component_stock_logic
+from controllers.idempotency import header_key, idempotency_store, request_fingerprint
 
 @app.post("/login", response_model=Token)
 async def login_compat(user_data: UserLogin, db: Prisma = Depends(get_db)):
@@ -220,35 +224,50 @@ async def update_relationship_compat(
 
 @app.delete("/relationships", response_model=dict)
 async def delete_relationship_compat(
-    topComponent: str = Query(...),
-    subComponent: str = Query(...),
+    topComponent: Optional[str] = Query(None),
+    subComponent: Optional[str] = Query(None),
+    topNodeId: Optional[int] = Query(None),
+    subNodeId: Optional[int] = Query(None),
+    root: Optional[str] = Query(None),
+    graphVersion: Optional[str] = Query(None),
     db: Prisma = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    return await delete_relationship(topComponent, subComponent, db, current_user)
+    return await delete_relationship(topComponent, subComponent, db, current_user, topNodeId, subNodeId, root, graphVersion)
 
 @app.get("/tree", response_model=dict)
 async def get_tree_compat(
     topName: str = Query(...),
+    format: TreeFormat = Query(TreeFormat.tree),
+    depth: Optional[int] = Query(None, ge=1),
+    stream: bool = Query(False),
     db: Prisma = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    return await get_tree(topName, db, current_user)
+    return await get_tree(topName, db, current_user, format, depth, stream)
 
 @app.get("/graph", response_model=dict)
 async def get_graph_compat(
     topName: str = Query(...),
+    format: GraphFormat = Query(GraphFormat.tree),
+    depth: Optional[int] = Query(None, ge=1),
     db: Prisma = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    return await get_graph(topName, db, current_user)
+    return await get_graph(topName, db, current_user, format, depth)
 
 @app.on_event("startup")
 async def startup():
     await connect_db()
+    await bom_closure.ensure_closure_built(prisma)
+    stock_ledger.start(prisma)
+    if COST_SNAPSHOTS_ENABLED:
+        cost_snapshots.start_snapshot_job(prisma)
 
 @app.on_event("shutdown")
 async def shutdown():
+    await cost_snapshots.stop_snapshot_job()
+    await stock_ledger.stop()
     await disconnect_db()
 
 @app.get("/health")
@@ -324,17 +343,50 @@ async def scan_update_endpoint(
     amount: float = Query(...),
     absolute: bool = Query(False),
     scannedBy: str = Query(""),
+    cascade: bool = Query(False, description="Consume the leaf parts of the whole BOM instead of the direct sub-components"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     db: Prisma = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    return await update_component_stock_logic(
-        component_name=component_name,
-        amount=amount,
-        absolute=absolute,
-        scannedBy=scannedBy,
-        db=db,
-        current_user=current_user
-    )
+    async def apply():
+        component = await update_component_stock_logic(
+            component_name=component_name,
+            amount=amount,
+            absolute=absolute,
+            scannedBy=scannedBy,
+            db=db,
+            current_user=current_user,
+            cascade=cascade
+        )
+        return jsonable_encoder(component)
+    
+    # Retries with the same key are answered from the first response
+    key = header_key(current_user.username, idempotency_key)
+    fingerprint = request_fingerprint("POST", "/components/scan-update", {
+        "component_name": component_name,
+        "amount": amount,
+        "absolute": absolute,
+        "scannedBy": scannedBy,
+        "cascade": cascade,
+    })
+    return await idempotency_store.run(key, db, apply, fingerprint)
+
+@app.post("/components/scan-batch", response_model=dict)
+async def scan_batch_endpoint(
+    batch: ScanBatchRequest = Body(...),
+    db: Prisma = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Replay a queue of offline scans in order, in one transaction."""
+    try:
+        results = await apply_scan_batch(batch.scans, db, current_user.username)
+        return {
+            "applied": sum(1 for result in results if result["status"] == "applied"),
+            "rejected": sum(1 for result in results if result["status"] == "rejected"),
+            "results": results
+        }
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not apply scan batch: {str(e)}")
 
 @app.put("/components/{component_name}/stock", response_model=Component)
 async def update_component_stock(
@@ -342,17 +394,34 @@ async def update_component_stock(
     amount: float = Query(...),
     absolute: bool = Query(False),
     scannedBy: str = Query("manual"),
+    cascade: bool = Query(False, description="Consume the leaf parts of the whole BOM instead of the direct sub-components"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     db: Prisma = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    return await update_component_stock_logic(
-        component_name=component_name,
-        amount=amount,
-        absolute=absolute,
-        scannedBy=scannedBy,
-        db=db,
-        current_user=current_user
-    )
+    async def apply():
+        component = await update_component_stock_logic(
+            component_name=component_name,
+            amount=amount,
+            absolute=absolute,
+            scannedBy=scannedBy,
+            db=db,
+            current_user=current_user,
+            cascade=cascade,
+            source=StockMovementSource.manual
+        )
+        return jsonable_encoder(component)
+    
+    # Retries with the same key are answered from the first response
+    key = header_key(current_user.username, idempotency_key)
+    fingerprint = request_fingerprint("PUT", "/components/{component_name}/stock", {
+        "component_name": component_name,
+        "amount": amount,
+        "absolute": absolute,
+        "scannedBy": scannedBy,
+        "cascade": cascade,
+    })
+    return await idempotency_store.run(key, db, apply, fingerprint)
 
 @app.get("/components/low-stock", response_model=dict)
 async def get_low_stock_components(
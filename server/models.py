@@ -131,9 +131,38 @@ class Component(BaseModel):
     class Config:
         from_attributes = True
 
-class ComponentHistory(BaseModel):
+class ScanBatchItem(BaseModel):
+    clientId: str  # Unique per scan on the device; a scan already applied is not applied again
     componentName: str
     amount: float
+    absolute: bool = False
+    scannedBy: str = ""
+    scannedAt: Optional[datetime] = None  # When the scan happened on the device
+
+class ScanBatchRequest(BaseModel):
+    scans: List[ScanBatchItem]
+
+class ChangeEntity(str, Enum):
+    component = "component"
+    relationship = "relationship"
+    stage = "stage"
+
+class ChangeOperation(str, Enum):
+    upsert = "upsert"
+    delete = "delete"
+
+class StockMovementSource(str, Enum):
+    scan = "scan"
+    manual = "manual"
+    assembly_consumption = "assembly_consumption"
+    batch = "batch"
+
+class ComponentHistory(BaseModel):
+    id: Optional[int] = None
+    componentName: str
+    amount: float  # Stock after the movement
+    delta: float = 0
+    source: StockMovementSource = StockMovementSource.scan
     scanned: datetime
     scannedBy: str
 
@@ -181,10 +210,15 @@ class LaborProfile(BaseModel):
         from_attributes = True
 
 class RelationshipCreate(BaseModel):
-    topComponent: str
-    subComponent: str
+    topComponent: Optional[str] = None
+    subComponent: Optional[str] = None
     root: str
     amount: float
+    # Node ids from /graph?format=compact, accepted instead of names/paths,
+    # together with the version of the graph they were taken from
+    topNodeId: Optional[int] = None
+    subNodeId: Optional[int] = None
+    graphVersion: Optional[str] = None
 
 class RelationshipRequest(BaseModel):
     topComponent: str
@@ -199,11 +233,68 @@ class TreeNode(BaseModel):
     name: str
     amount: float
     children: List['TreeNode'] = []
+    childCount: Optional[int] = None  # Set on unexpanded nodes at a depth cutoff
 
 class ComponentTree(BaseModel):
     root: str
     nodes: List[TreeNode]
 
+class CostedTreeNode(BaseModel):
+    name: str
+    amount: float
+    quantity: float  # Cumulative quantity per unit of the root
+    ownCost: float
+    ownLaborCost: float
+    # Rolled-up per unit, including everything below the node
+    materialCost: float
+    laborCost: float
+    totalCost: float
+    duration: float
+    children: List['CostedTreeNode'] = []
+
+class TreeFormat(str, Enum):
+    tree = "tree"
+    dag = "dag"
+
+class GraphFormat(str, Enum):
+    tree = "tree"
+    dag = "dag"
+    compact = "compact"
+
+class BomDagEdge(BaseModel):
+    source: str
+    target: str
+    amount: float
+
+class BomDag(BaseModel):
+    root: str
+    nodes: List[str]
+    edges: List[BomDagEdge]
+
+class WhereUsedEntry(BaseModel):
+    componentName: str
+    type: Optional[TypeOfComponent] = None
+    quantityPer: float
+    depth: int
+
+# BOM explosion models
+class ExplodeLine(BaseModel):
+    component: str
+    quantity: float
+
+class ExplodeRequest(BaseModel):
+    items: List[ExplodeLine]
+
+# What-if pricing models
+class WhatIfScenario(BaseModel):
+    name: Optional[str] = None
+    prices: Dict[str, float] = {}  # componentName -> material cost per unit
+    rates: Dict[str, float] = {}  # labor profile id or name -> hourly rate
+
+class WhatIfRequest(BaseModel):
+    scenarios: List[WhatIfScenario]
+    components: Optional[List[str]] = None  # Defaults to the printers
+
 class AppUser(BaseModel):
     name: str
     surname: str